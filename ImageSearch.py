@@ -2,6 +2,7 @@ from werkzeug.utils import secure_filename
 import requests
 from dotenv import load_dotenv
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient, SearchIndexerClient
 try:
@@ -33,14 +34,99 @@ from azure.search.documents.indexes.models import (
 )
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
 import os
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import logging
+import math
+import threading
 import time
+import uuid
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException, Timeout, ConnectionError
+from deadline import DeadlineExceeded, timeout_for
+from hedging import ClientError, EndpointPool, is_client_error, parse_endpoints
+from phash_cache import cosine_similarity, get_phash_cache
+import memory_stats
+
+# Ways to combine several images of one request into a single search, see search_image_files_fused
+FUSION_MODES = ("mean", "max", "multi")
+
+
+# Clients are shared by every ImageSearchAPI instance in a worker so that
+# connection pools (and their TLS sessions) survive across requests.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(key, factory):
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = factory()
+                _clients[key] = client
+    return client
+
+
+def get_search_client(endpoint, index_name, key):
+    return _get_client(
+        ("search", endpoint, index_name),
+        lambda: SearchClient(endpoint, index_name, AzureKeyCredential(key))
+    )
+
+
+def get_container_client(connection_string, container_name):
+    def factory():
+        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+        return blob_service_client.get_container_client(container_name)
+    return _get_client(("blob", connection_string, container_name), factory)
+
+
+def get_vision_session():
+    def factory():
+        pool_size = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return _get_client(("vision",), factory)
+
+
+def get_endpoint_pool(service, targets):
+    return _get_client(
+        ("pool", service, tuple(target["url"] for target in targets)),
+        lambda: EndpointPool(service, targets)
+    )
+
+
+def get_endpoint_pools():
+    with _clients_lock:
+        return [client for key, client in _clients.items() if key[0] == "pool"]
+
+
+def unique_blob_name(filename):
+    """Blob name for one upload.
+
+    Clients often send the same name (image.jpg, or none at all), and Vision fetches the
+    blob by URL after the upload, so equal names in concurrent uploads would overwrite
+    each other and vectorize the wrong image. The uuid prefix keeps every upload apart;
+    embed_image_file deletes the blob once Vision has vectorized it, so unique names
+    don't accumulate in the container.
+    """
+    return f"{uuid.uuid4().hex}-{secure_filename(filename) or 'upload'}"
+
+
+def reset_clients():
+    """Drop all shared clients, used after fork so workers never share sockets with the master"""
+    with _clients_lock:
+        _clients.clear()
 
 
 class ImageSearchAPI:
     def __init__(self, indexName: str = None, topK: int = None):
         load_dotenv()
+        memory_stats.register_api(self)
         self.topK = topK
         
         # Setup logging
@@ -51,12 +137,28 @@ class ImageSearchAPI:
         self.service_endpoint = os.getenv("AZURE_SEARCH_SERVICE_ENDPOINT")
         self.indexName = indexName
         self.search_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
-        self.search_client = SearchClient(self.service_endpoint, self.indexName, AzureKeyCredential(self.search_key))
+        # Optional replicas: AZURE_SEARCH_SERVICE_ENDPOINTS / AZURE_SEARCH_ADMIN_KEYS (comma separated)
+        self.search_endpoints = parse_endpoints(
+            os.getenv("AZURE_SEARCH_SERVICE_ENDPOINTS"), os.getenv("AZURE_SEARCH_ADMIN_KEYS"),
+            self.service_endpoint, self.search_key
+        )
+        if not self.search_endpoints:
+            raise ValueError("AZURE_SEARCH_SERVICE_ENDPOINT or AZURE_SEARCH_SERVICE_ENDPOINTS environment variable is not set")
+        # The replica list wins over the single endpoint variables when both are set
+        primary_search = self.search_endpoints[0]
+        self.search_client = get_search_client(primary_search["url"], self.indexName, primary_search["key"])
+        self.search_pool = get_endpoint_pool("search", self.search_endpoints)
 
         # Azure AI Vision configurations
         self.aiVisionEndpoint = os.getenv("AZURE_AI_VISION_ENDPOINT")
         self.aiVisionApiKey = os.getenv("AZURE_AI_VISION_API_KEY")
         self.aiVisionModelVersion = os.getenv("AZURE_AI_VISION_MODEL_VERSION", "2024-02-01")
+        # Optional replicas: AZURE_AI_VISION_ENDPOINTS / AZURE_AI_VISION_API_KEYS (comma separated)
+        self.vision_endpoints = parse_endpoints(
+            os.getenv("AZURE_AI_VISION_ENDPOINTS"), os.getenv("AZURE_AI_VISION_API_KEYS"),
+            self.aiVisionEndpoint, self.aiVisionApiKey
+        )
+        self.vision_pool = get_endpoint_pool("vision", self.vision_endpoints)
 
         # Blob storage configurations
         self.blob_connection_string = os.getenv("BLOB_CONNECTION_STRING")
@@ -70,21 +172,24 @@ class ImageSearchAPI:
             raise ValueError("Connection string missing required connection details.")
             
         try:
-            blob_service_client = BlobServiceClient.from_connection_string(self.blob_connection_string)
-            self.container_client = blob_service_client.get_container_client(self.container_name)
+            self.container_client = get_container_client(self.blob_connection_string, self.container_name)
         except Exception as e:
             raise ValueError(f"Failed to create blob service client: {str(e)}")
 
-    def generate_embeddings(self, image_url):
+    def generate_embeddings(self, image_url, deadline=None):
+        # Routed to the fastest Vision endpoint and hedged when it is slow, see hedging.py
+        return self.vision_pool.call(lambda target: self._vectorize_image(target, image_url, deadline), deadline)
+
+    def _vectorize_image(self, target, image_url, deadline=None):
         # Remove trailing slash if exists
-        endpoint = self.aiVisionEndpoint.rstrip('/')
+        endpoint = target["url"].rstrip('/')
         # Use the correct Azure AI Vision vectorize endpoint
         url = f"{endpoint}/computervision/retrieval:vectorizeImage"
         params = {
             "api-version": self.aiVisionModelVersion,
             "model-version": "2023-04-15"  # Use multilingual model
         }
-        headers = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": self.aiVisionApiKey}
+        headers = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": target["key"]}
         data = {"url": image_url}
         
         # Start timing for performance monitoring
@@ -95,7 +200,9 @@ class ImageSearchAPI:
         
         try:
             # Add timeout to prevent hanging
-            response = requests.post(url, params=params, headers=headers, json=data, timeout=30)
+            response = get_vision_session().post(
+                url, params=params, headers=headers, json=data, timeout=timeout_for(deadline, 30)
+            )
             
             # Calculate response time
             response_time = time.time() - start_time
@@ -112,10 +219,16 @@ class ImageSearchAPI:
                 else:
                     self.logger.error("Error: No 'vector' field in response")
                     return None
+            elif is_client_error(response.status_code):
+                # The image itself was rejected, another Vision endpoint would answer the same
+                self.logger.error(f"API Error {response.status_code}: {response.text}")
+                raise ClientError(f"Vision rejected the image with HTTP {response.status_code}")
             else:
                 self.logger.error(f"API Error {response.status_code}: {response.text}")
                 return None
                 
+        except ClientError:
+            raise
         except Timeout:
             self.logger.error("Request timeout - Azure AI Vision API took too long to respond")
             return None
@@ -129,16 +242,50 @@ class ImageSearchAPI:
             self.logger.error(f"Unexpected error in generate_embeddings: {str(e)}")
             return None
 
-    def search_with_embeddings(self, embeddings):
+    def search_with_embeddings(self, embeddings, deadline=None):
+        return self.search_with_vectors([embeddings], deadline)
+
+    def search_with_vectors(self, vectors, deadline=None, include_vectors=False):
+        """Run one search with a vector query per entry of vectors.
+
+        Several vector queries in one call are merged by the service (reciprocal rank
+        fusion), so their @search.score is a fused rank score, not a cosine similarity.
+        With include_vectors, each result also carries its stored "imageVector"
+        (the field must be retrievable in the index). Returns None when the search
+        failed, so an outage is not mistaken for an image without matches.
+        """
         try:
             start_time = time.time()
             
-            vector_query = RawVectorQuery(vector=embeddings, k=self.topK, fields="imageVector")
-            results = self.search_client.search(
-                search_text=None, 
-                vector_queries=[vector_query],
-                select=["title", "imageUrl"]  # Remove @search.score from select
-            )
+            vector_queries = [RawVectorQuery(vector=vector, k=self.topK, fields="imageVector") for vector in vectors]
+            select = ["title", "imageUrl"] + (["imageVector"] if include_vectors else [])
+
+            def run_query(target):
+                search_client = get_search_client(target["url"], self.indexName, target["key"])
+                # Bound the SDK's socket timeouts and retries by the request deadline
+                timeouts = {}
+                if deadline is not None:
+                    remaining = deadline.timeout()
+                    timeouts = {"timeout": remaining, "connection_timeout": remaining, "read_timeout": remaining}
+                # Materialise here so the whole round trip is timed and hedged
+                try:
+                    return list(search_client.search(
+                        search_text=None, 
+                        vector_queries=vector_queries,
+                        select=select,  # Remove @search.score from select
+                        top=self.topK,
+                        **timeouts
+                    ))
+                except HttpResponseError as e:
+                    # A bad query (e.g. a retrievable field missing) fails on every replica
+                    if is_client_error(e.status_code):
+                        raise ClientError(str(e))
+                    raise
+
+            results = self.search_pool.call(run_query, deadline)
+            if results is None:
+                self.logger.error("Vector search failed on every search endpoint")
+                return None
             
             search_time = time.time() - start_time
             self.logger.info(f"Vector Search Time: {search_time:.2f} seconds")
@@ -155,6 +302,8 @@ class ImageSearchAPI:
                     "confidence_score": round(confidence_score, 4),
                     "similarity_percentage": round(confidence_score * 100, 2)
                 }
+                if include_vectors:
+                    result_with_confidence["imageVector"] = result.get("imageVector")
                 processed_results.append(result_with_confidence)
             
             self.logger.info(f"Found {len(processed_results)} results")
@@ -162,60 +311,244 @@ class ImageSearchAPI:
             
         except Exception as e:
             self.logger.error(f"Error in search_with_embeddings: {str(e)}")
-            return []
+            return None
 
-    def search_image_file(self, file_storage=None):
-        # Save the file to a temporary location
+    @staticmethod
+    def _end_stage(timings, stage, stage_start):
+        now = time.time()
+        if timings is not None:
+            timings[stage] = round((now - stage_start) * 1000, 1)
+        return now
+
+    def _delete_blob(self, blob_client):
+        # Best effort with a short timeout of its own: the request deadline may already be spent
         try:
-            if not file_storage:
-                self.logger.warning("No file provided for search")
-                return None
-                
-            start_time = time.time()
-            self.logger.info(f"Starting image search for file: {file_storage.filename}")
-            
-            filename = secure_filename(file_storage.filename)
-            temp_dir = "/tmp"  # Update the directory path as needed
-            os.makedirs(temp_dir, exist_ok=True)  # Ensure the directory exists
+            blob_client.delete_blob(timeout=5, connection_timeout=5, read_timeout=5)
+        except ResourceNotFoundError:
+            pass  # the upload never committed
+        except Exception as e:
+            self.logger.warning(f"Failed to delete uploaded blob {blob_client.blob_name}: {str(e)}")
 
-            temp_path = os.path.join(temp_dir, filename)
-            file_storage.save(temp_path)
+    def embed_image_file(self, file_storage, deadline=None, timings=None, reuse_results=True):
+        """Upload one image and vectorize it, reusing a perceptual-hash match when possible.
 
-            with open(temp_path, "rb") as image_file:
-                image_data = image_file.read()
-                
-            # Upload image to Blob Storage
-            blob_name = os.path.basename(temp_path)
-            blob_client = self.container_client.get_blob_client(blob_name)
-            
+        Returns (embeddings, cached_entry, results). embeddings is None when the upload or
+        the Vision call failed; results is only set when reuse_results is on and the cache
+        already holds this index's results for a near-duplicate. A near-duplicate hit that
+        is not audited is not uploaded.
+        """
+        stage_start = time.time()
+        blob_name = unique_blob_name(file_storage.filename)
+        image_stream = file_storage.stream
+        image_stream.seek(0, os.SEEK_END)
+        image_size = image_stream.tell()
+        image_stream.seek(0)
+
+        # Near-duplicate lookup: re-shot or re-compressed photos reuse a prior embedding
+        phash_cache = get_phash_cache()
+        image_hash = phash_cache.hash_image(image_stream) if phash_cache else None
+        cached_entry = phash_cache.lookup(image_hash) if image_hash is not None else None
+        image_stream.seek(0)
+        stage_start = self._end_stage(timings, "phash", stage_start)
+
+        audit = False
+        if cached_entry is not None:
+            # Auditing costs an extra Vision call, only do it when the deadline leaves room.
+            # Shadow mode audits every hit: it always vectorizes and never serves the cache.
+            audit = phash_cache.shadow or phash_cache.should_audit() and (
+                deadline is None or deadline.remaining() > 2 * self.vision_pool.expected_latency()
+            )
+            if not audit:
+                # Reusing the match needs neither the blob nor a Vision call, skip the upload
+                results = phash_cache.get_results(cached_entry, self.indexName, self.topK) if reuse_results else None
+                if results is not None:
+                    self.logger.info("Reusing search results of a perceptual-hash match")
+                else:
+                    self.logger.info("Reusing embeddings of a perceptual-hash match")
+                self._end_stage(timings, "vectorize", stage_start)
+                return cached_entry["embeddings"], cached_entry, results
+
+        # Upload image to Blob Storage
+        if deadline is not None:
+            deadline.check("blob upload")
+        blob_client = self.container_client.get_blob_client(blob_name)
+        try:
             try:
-                blob_client.upload_blob(image_data, overwrite=True, timeout=30)
+                upload_timeout = timeout_for(deadline, 30)
+                blob_client.upload_blob(
+                    image_stream, length=image_size, overwrite=True,
+                    timeout=max(1, int(upload_timeout)), connection_timeout=upload_timeout, read_timeout=upload_timeout
+                )
                 image_url = blob_client.url
-                self.logger.info(f"Image uploaded to blob storage: {blob_name}")
+                self.logger.info(f"Image uploaded to blob storage: {blob_name} ({image_size} bytes)")
+                stage_start = self._end_stage(timings, "upload", stage_start)
             except Exception as e:
                 self.logger.error(f"Failed to upload to blob storage: {str(e)}")
+                return None, None, None
+
+            # Generate embeddings; an audited near-duplicate hit checks its cached embedding against a fresh one
+            if audit and not phash_cache.shadow:
+                embeddings = cached_entry["embeddings"]
+                fresh_embeddings = self.generate_embeddings(image_url, deadline)
+                if fresh_embeddings:
+                    phash_cache.audit(cached_entry, fresh_embeddings)
+                    embeddings = fresh_embeddings
+            else:
+                if deadline is not None:
+                    deadline.check("vectorize", self.vision_pool.expected_latency())
+                embeddings = self.generate_embeddings(image_url, deadline)
+                if embeddings is None and deadline is not None and deadline.expired():
+                    raise DeadlineExceeded("Deadline exceeded during vectorize")
+                if embeddings and cached_entry is not None:
+                    # Shadow mode: measure what reusing the hit would have returned, but don't use it
+                    phash_cache.audit(cached_entry, embeddings)
+                elif embeddings and image_hash is not None:
+                    cached_entry = phash_cache.store(image_hash, embeddings)
+
+            self._end_stage(timings, "vectorize", stage_start)
+            return embeddings, cached_entry, None
+        finally:
+            # Every upload has its own name, so it must not outlive the Vision call
+            self._delete_blob(blob_client)
+
+    def search_image_file(self, file_storage=None, deadline=None, timings=None):
+        # The upload is streamed straight from the request's spooled buffer, it is never
+        # copied to /tmp or read fully into memory. If given, timings is filled with
+        # per-stage durations in milliseconds.
+        try:
+            if not file_storage:
+                self.logger.warning("No file provided for search")
                 return None
+                
+            start_time = time.time()
+            self.logger.info(f"Starting image search for file: {file_storage.filename}")
+
+            embeddings, cached_entry, results = self.embed_image_file(file_storage, deadline, timings)
+            stage_start = time.time()
 
-            # Generate embeddings and search
-            embeddings = self.generate_embeddings(image_url)
             if embeddings:
-                results = self.search_with_embeddings(embeddings)
-                
+                if results is None:
+                    if deadline is not None:
+                        deadline.check("vector search", self.search_pool.expected_latency())
+                    results = self.search_with_embeddings(embeddings, deadline)
+                    if results is None:
+                        if deadline is not None and deadline.expired():
+                            raise DeadlineExceeded("Deadline exceeded during vector search")
+                        self.logger.error("Vector search failed")
+                        return None
+                    if cached_entry is not None and results:
+                        get_phash_cache().store_results(cached_entry, self.indexName, self.topK, results)
+                self._end_stage(timings, "search", stage_start)
+
                 total_time = time.time() - start_time
+                self._end_stage(timings, "total", start_time)
                 self.logger.info(f"Total search process time: {total_time:.2f} seconds")
-                
-                # Clean up temporary file
-                try:
-                    os.remove(temp_path)
-                    self.logger.debug(f"Cleaned up temporary file: {temp_path}")
-                except:
-                    pass
-                    
                 return results
             else:
                 self.logger.error("Failed to generate embeddings")
                 return None
+
+        except DeadlineExceeded as e:
+            # Let the caller tell a timed-out request from a failed one
+            self.logger.warning(str(e))
+            raise
                 
         except Exception as e:
             self.logger.error(f"An error occurred while processing the request: {str(e)}")
             return None
+
+    @staticmethod
+    def fuse_embeddings(vectors, fusion="mean"):
+        """Combine unit-normalized embeddings into one query vector (mean or elementwise max)"""
+        normalized = []
+        for vector in vectors:
+            norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+            normalized.append([x / norm for x in vector])
+        if fusion == "max":
+            fused = [max(values) for values in zip(*normalized)]
+        else:
+            fused = [sum(values) / len(normalized) for values in zip(*normalized)]
+        norm = math.sqrt(sum(x * x for x in fused)) or 1.0
+        return [x / norm for x in fused]
+
+    def search_image_files_fused(self, file_storages, fusion="mean", deadline=None, timings=None, executor=None):
+        """Search several photos of the same object as one query, in one search round trip.
+
+        fusion is "mean" or "max" (embeddings combined into one vector query) or "multi"
+        (one vector query per image in the same call, merged by the service). Images are
+        vectorized in parallel when an executor is given, each uploaded under its own blob
+        name (see unique_blob_name) even when the photos share a file name; images that
+        fail are left out.
+
+        Returns one ranked result list. When SEARCH_VECTOR_RETRIEVABLE is set, every hit
+        carries "contributions": per image, the cosine similarity of its embedding to the
+        hit's stored vector. Returns None when no image could be vectorized or the search
+        failed.
+        """
+        if fusion not in FUSION_MODES:
+            raise ValueError(f"Unknown fusion mode {fusion}, expected one of {', '.join(FUSION_MODES)}")
+        try:
+            start_time = time.time()
+            self.logger.info(f"Starting fused ({fusion}) search for {len(file_storages)} files")
+
+            def embed(file_storage):
+                embeddings, _, _ = self.embed_image_file(file_storage, deadline, reuse_results=False)
+                return embeddings
+
+            if executor is not None and len(file_storages) > 1:
+                futures = [executor.submit(embed, file_storage) for file_storage in file_storages]
+                try:
+                    embeddings_list = [
+                        future.result(timeout=deadline.remaining() if deadline is not None else None)
+                        for future in futures
+                    ]
+                except FuturesTimeoutError:
+                    raise DeadlineExceeded("Deadline exceeded during vectorize")
+            else:
+                embeddings_list = [embed(file_storage) for file_storage in file_storages]
+            stage_start = self._end_stage(timings, "vectorize", start_time)
+
+            vectors = [embeddings for embeddings in embeddings_list if embeddings]
+            if not vectors:
+                self.logger.error("Failed to generate embeddings for every file")
+                return None
+
+            queries = vectors if fusion == "multi" else [self.fuse_embeddings(vectors, fusion)]
+            include_vectors = os.getenv("SEARCH_VECTOR_RETRIEVABLE", "0").lower() in ("1", "true", "yes")
+            if deadline is not None:
+                deadline.check("vector search", self.search_pool.expected_latency())
+            results = self.search_with_vectors(queries, deadline, include_vectors)
+            if results is None:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded("Deadline exceeded during vector search")
+                self.logger.error("Vector search failed")
+                return None
+            self._end_stage(timings, "search", stage_start)
+
+            for result in results:
+                # Without the stored vector every hit would get the same numbers, so leave them out
+                result_vector = result.pop("imageVector", None)
+                if not result_vector:
+                    continue
+                similarities = [
+                    round(cosine_similarity(embeddings, result_vector), 4) if embeddings else None
+                    for embeddings in embeddings_list
+                ]
+                # Multi-angle shots from a phone often share a name, the position tells them apart
+                result["contributions"] = [
+                    {"position": position, "file": file_storage.filename, "similarity": similarity}
+                    for position, (file_storage, similarity) in enumerate(zip(file_storages, similarities))
+                ]
+
+            total_time = time.time() - start_time
+            self._end_stage(timings, "total", start_time)
+            self.logger.info(f"Total fused search process time: {total_time:.2f} seconds")
+            return results
+
+        except DeadlineExceeded as e:
+            self.logger.warning(str(e))
+            raise
+
+        except Exception as e:
+            self.logger.error(f"An error occurred while processing the fused search: {str(e)}")
+            return None
@@ -1,10 +1,43 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
-from http_status_codes import HTTP_200_OK
-from ImageSearch import ImageSearchAPI
+from bounded_upload import BoundedRequest, BoundedSpooledFile, MAX_BATCH_BYTES, MAX_FILE_BYTES, MAX_REQUEST_BYTES
+from deadline import Deadline, DeadlineExceeded
+from http_status_codes import (
+    HTTP_200_OK,
+    HTTP_403_FORBIDDEN,
+    HTTP_404_NOT_FOUND,
+    HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+    HTTP_502_BAD_GATEWAY,
+    HTTP_503_SERVICE_UNAVAILABLE,
+    HTTP_504_GATEWAY_TIMEOUT,
+)
+from ImageSearch import FUSION_MODES, ImageSearchAPI, get_endpoint_pools
+from phash_cache import get_phash_cache
+from search_response import (
+    MSGPACK_MIMETYPES,
+    ORIGINAL_FILE_BASE_URL,
+    accepts_msgpack,
+    format_search_results,
+    json_response,
+    msgpack,
+    msgpack_response,
+    parse_fields,
+    project_fields,
+    to_compact,
+)
+import io
 import os
+import shutil
+import uuid
+import memory_stats
+import request_profiler
+import traffic_capture
+import warmup
 
 # Load environment variables
 try:
@@ -14,15 +47,89 @@ except ImportError:
     pass  # dotenv not available in production
 
 app = Flask(__name__)
+app.request_class = BoundedRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 CORS(app)
 executor = ThreadPoolExecutor()
 
 
+@app.before_request
+def start_profiling():
+    # Opt-in CPU profiling, see request_profiler.py
+    if request_profiler.should_profile(request.headers.get('X-Profile')):
+        g.profiler = request_profiler.SamplingProfiler(
+            uuid.uuid4().hex, client_request_id=request.headers.get('X-Request-ID')
+        ).start()
+
+
+@app.after_request
+def stop_profiling(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        request_profiler.store.add(profiler, request.method, request.path, response.status_code)
+        response.headers['X-Profile-Id'] = profiler.profile_id
+    return response
+
+
+@app.teardown_request
+def discard_profiling(exception=None):
+    # Unhandled errors skip after_request, make sure the sampler thread still stops
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+
+
+@app.before_request
+def start_traffic_capture():
+    # Opt-in traffic capture for replay_traffic.py, see traffic_capture.py
+    if traffic_capture.should_capture(request.path):
+        g.traffic_capture = traffic_capture.TrafficCapture(
+            request.path, request.headers.get('Accept'), request.headers.get('Accept-Encoding')
+        )
+
+
+@app.after_request
+def finish_traffic_capture(response):
+    capture = g.pop('traffic_capture', None)
+    if capture is not None:
+        capture.finish(response.status_code)
+    return response
+
+
+@app.before_request
+def start_memory_stats():
+    # Per-request RSS delta, see memory_stats.py
+    if memory_stats.is_enabled():
+        memory_stats.ensure_started()
+        g.rss_before = memory_stats.rss_bytes()
+
+
+@app.after_request
+def finish_memory_stats(response):
+    rss_before = g.pop('rss_before', None)
+    if rss_before is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        memory_stats.request_stats.record(endpoint, rss_before, memory_stats.rss_bytes())
+    return response
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return {"status": "healthy", "message": "API is running"}, HTTP_200_OK
 
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Report ready only once this worker has finished its post-fork warm-up"""
+    # No gunicorn post_worker_init hook ran in this process (wsgi.py, app.run): warm up now
+    warmup.start_in_background()
+    status = warmup.get_status()
+    if warmup.is_ready():
+        return status, HTTP_200_OK
+    return status, HTTP_503_SERVICE_UNAVAILABLE
+
+
 @app.route('/debug/env', methods=['GET'])
 def debug_env():
     import os
@@ -37,6 +144,65 @@ def debug_env():
     return env_vars, HTTP_200_OK
 
 
+@app.route('/stats/phash', methods=['GET'])
+def phash_stats():
+    """Perceptual-hash cache match rate and audited false hits for this worker"""
+    cache = get_phash_cache()
+    if cache is None:
+        return {"enabled": False}, HTTP_200_OK
+    return {"enabled": True, **cache.get_stats()}, HTTP_200_OK
+
+
+@app.route('/debug/profiles', methods=['GET'])
+def list_profiles():
+    if not request_profiler.check_admin_token(request.headers.get('X-Admin-Token')):
+        return {"error": "Forbidden"}, HTTP_403_FORBIDDEN
+    return jsonify(request_profiler.store.list())
+
+
+@app.route('/debug/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Folded stacks of one profiled request, ready for flamegraph.pl or speedscope"""
+    if not request_profiler.check_admin_token(request.headers.get('X-Admin-Token')):
+        return {"error": "Forbidden"}, HTTP_403_FORBIDDEN
+    profile = request_profiler.store.get(profile_id)
+    if profile is None:
+        return {"error": f"No profile {profile_id}"}, HTTP_404_NOT_FOUND
+    return Response(profile["folded"], mimetype="text/plain")
+
+
+@app.route('/stats/hedging', methods=['GET'])
+def hedging_stats():
+    """Per-endpoint latency, hedge rate and hedge win statistics for Vision and Search"""
+    return {pool.service: pool.get_stats() for pool in get_endpoint_pools()}, HTTP_200_OK
+
+
+@app.route('/stats/memory', methods=['GET'])
+def memory_summary():
+    """RSS, per-endpoint RSS growth and live ImageSearchAPI count for this worker"""
+    return jsonify(memory_stats.get_stats())
+
+
+@app.route('/admin/memory', methods=['GET'])
+def memory_report():
+    """Live SDK client counts and tracemalloc diffs by allocation site.
+
+    ?snapshot=1 takes a tracemalloc snapshot first, ?gc=1 runs a full collection first,
+    ?limit=N caps the number of allocation sites.
+    """
+    if not request_profiler.check_admin_token(request.headers.get('X-Admin-Token')):
+        return {"error": "Forbidden"}, HTTP_403_FORBIDDEN
+    try:
+        limit = int(request.args.get('limit', '0')) or None
+    except ValueError:
+        return {"error": "limit must be an integer"}, 400
+    return jsonify(memory_stats.get_report(
+        limit=limit,
+        snapshot=request.args.get('snapshot') == '1',
+        collect=request.args.get('gc') == '1',
+    ))
+
+
 @app.route('/home', methods=['GET'])
 def home():
     return "This is a SQL Search API", HTTP_200_OK
@@ -107,115 +273,375 @@ def test_search_init():
         return {"error": f"ImageSearchAPI initialization failed: {str(e)}"}, 500
 
 
+def request_deadline():
+    """Deadline from X-Request-Timeout (seconds) or X-Deadline (unix epoch), or ?timeout="""
+    return Deadline.from_request(
+        timeout=request.headers.get('X-Request-Timeout') or request.args.get('timeout'),
+        epoch_deadline=request.headers.get('X-Deadline'),
+    )
+
+
+def capture_request_shape(fields, compact, deadline, fusion=None):
+    capture = g.get('traffic_capture')
+    if capture is not None:
+        capture.set_shape(fields, compact, deadline, fusion)
+
+
+def search_file(image_search_api, indexName, file, fields=None, compact=False, deadline=None):
+    """Search one uploaded file and return its formatted results, or an error entry.
+
+    KeyError is left to the caller, which answers it with 400 for the whole request.
+    """
+    capture = g.get('traffic_capture')
+    timings = {} if capture is not None else None
+    future = None
+    ok = False
+    try:
+        if deadline is not None:
+            deadline.check(f"processing file {file.filename}")
+
+        filename = ORIGINAL_FILE_BASE_URL + str(secure_filename(file.filename))
+        future = executor.submit(request_profiler.wrap(image_search_api.search_image_file), file, deadline, timings)
+        # Stop waiting at the deadline; the worker's own timeouts are bounded by it too
+        results = future.result(timeout=deadline.remaining() if deadline is not None else None)
+
+        # Check if results is None (failed to get embeddings or search)
+        if results is None:
+            return {"error": f"Failed to process file {file.filename}: No results returned"}
+        ok = True
+
+        # Format search results for each file
+        formatted_results = format_search_results(indexName, filename, results)
+        formatted_results = project_fields(formatted_results, fields)
+        if compact:
+            formatted_results = to_compact(formatted_results)
+        return formatted_results
+
+    except KeyError:
+        raise
+
+    except (DeadlineExceeded, FuturesTimeoutError) as e:
+        return {
+            "error": f"Deadline exceeded while processing file {file.filename}: {str(e) or 'timed out'}",
+            "file": file.filename,
+            "index": indexName,
+            "error_type": "DeadlineExceeded",
+        }
+
+    except Exception as e:
+        # Handle other exceptions for individual files with detailed logging
+        import traceback
+        error_details = {
+            "error": f"ML service error: An error occurred while processing file {file.filename}: {str(e)}",
+            "file": file.filename,
+            "index": indexName,
+            "error_type": type(e).__name__,
+            "traceback": traceback.format_exc()
+        }
+        
+        # Log the error for debugging
+        print(f"ERROR processing {file.filename}: {error_details}")
+        return error_details
+
+    finally:
+        if capture is not None:
+            # A search still running past the deadline owns the stream, don't read it concurrently
+            capture.add_file(file, indexName, image_search_api.topK, timings, ok,
+                             read_payload=future is None or future.done())
+
+
+class _ProfiledExecutor:
+    """Submits through request_profiler.wrap so profiled requests also sample these threads"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def submit(self, func, *args):
+        return self.pool.submit(request_profiler.wrap(func), *args)
+
+
+def search_fused(image_search_api, indexName, files, fusion, fields=None, compact=False, deadline=None):
+    """Search all files of a request as one query and return one formatted result list.
+
+    Hits keep their per-image "contributions" when the index returns stored vectors;
+    originalFile lists all files. In multi mode the service merges the queries by
+    reciprocal rank fusion, so the score is sent as fusion_score instead of
+    confidence_score and similarity_percentage, which would read as a similarity.
+    """
+    capture = g.get('traffic_capture')
+    timings = {} if capture is not None else None
+    ok = False
+    try:
+        if deadline is not None:
+            deadline.check(f"processing {len(files)} files")
+
+        original_files = ",".join(ORIGINAL_FILE_BASE_URL + str(secure_filename(file.filename)) for file in files)
+        results = image_search_api.search_image_files_fused(
+            files, fusion, deadline, timings, executor=_ProfiledExecutor(executor)
+        )
+        if results is None:
+            return {"error": f"Failed to process files {', '.join(file.filename for file in files)}: No results returned"}
+        ok = True
+
+        formatted_results = format_search_results(indexName, original_files, results)
+        # format_search_results keeps one entry per result, in order
+        for formatted_result, result in zip(formatted_results, results):
+            if "contributions" in result:
+                formatted_result["contributions"] = result["contributions"]
+            if fusion == "multi":
+                formatted_result.pop("confidence_score", None)
+                formatted_result.pop("similarity_percentage", None)
+                formatted_result["fusion_score"] = result.get("confidence_score", 0)
+        formatted_results = project_fields(formatted_results, fields)
+        if compact:
+            formatted_results = to_compact(formatted_results)
+        return formatted_results
+
+    except (DeadlineExceeded, FuturesTimeoutError) as e:
+        return {
+            "error": f"Deadline exceeded while processing fused search: {str(e) or 'timed out'}",
+            "index": indexName,
+            "error_type": "DeadlineExceeded",
+        }
+
+    except Exception as e:
+        import traceback
+        error_details = {
+            "error": f"ML service error: An error occurred while processing fused search: {str(e)}",
+            "index": indexName,
+            "error_type": type(e).__name__,
+            "traceback": traceback.format_exc()
+        }
+        print(f"ERROR processing fused search: {error_details}")
+        return error_details
+
+    finally:
+        if capture is not None:
+            # Embedding threads may still hold the streams after a failure, only read them on success
+            for file in files:
+                capture.add_file(file, indexName, image_search_api.topK, timings, ok, read_payload=ok)
+
+
+def parse_topK(topK_str):
+    """topK as an int, or None when it is missing or not a valid integer"""
+    if topK_str is not None and str(topK_str).isdigit():
+        return int(topK_str)
+    return None
+
+
 @app.route('/search', methods=['POST'])
 def search():
     try:
         indexName = request.form.get('indexName')
 
-        topK_str = request.form.get('topK')
-        if topK_str is not None and topK_str.isdigit():
-            topK = int(topK_str)
-        else:
+        topK = parse_topK(request.form.get('topK'))
+        if topK is None:
             return jsonify({"error": "Invalid topK parameter. It must be a valid integer."}), 400
-            
+
+        try:
+            deadline = request_deadline()
+        except ValueError:
+            return jsonify({"error": "Invalid request timeout or deadline."}), 400
+
+        # Optional response shaping: fields=a,b,c projection and format=compact columnar rows
+        fields = parse_fields(request.values.get('fields'))
+        compact = request.values.get('format', '').lower() == 'compact'
+
+        # Optional fusion=mean|max|multi: search all files as one query, one result list
+        fusion = request.values.get('fusion', '').lower() or None
+        if fusion is not None and fusion not in FUSION_MODES:
+            return jsonify({"error": f"Invalid fusion parameter. It must be one of: {', '.join(FUSION_MODES)}."}), 400
+        capture_request_shape(fields, compact, deadline, fusion)
+
         files = request.files.getlist('files')  # Get list of files
         image_search_api = ImageSearchAPI(indexName=indexName, topK=topK)
+        if fusion is not None and files:
+            formatted_results_all = [
+                search_fused(image_search_api, indexName, files, fusion, fields, compact, deadline)
+            ]
+            return json_response(formatted_results_all, request.headers.get('Accept-Encoding'))
+
         formatted_results_all = []
         for file in files:
             try:
-                filename = 'https://filestoragepath.blob.core.windows.net/file-test-storage/' + str(
-                    secure_filename(file.filename))
-                with ThreadPoolExecutor() as executor:
-                    future = executor.submit(image_search_api.search_image_file, file)
-                    results = future.result()
-
-                # Check if results is None (failed to get embeddings or search)
-                if results is None:
-                    formatted_results_all.append({"error": f"Failed to process file {file.filename}: No results returned"})
-                    continue
-
-                # Format search results for each file
-                formatted_results = []
-                for result in results:
-                    if indexName == "product-pro-type-code-part" or indexName == "product-pro-type-code-used" or \
-                            indexName == "product-pro-type-code-packaging":
-                        product_type = str(result['title']).split("-")[0]
-                        product_code = str(result['title']).split("-")[1]
-                        formatted_result = {
-                            "modelName": indexName,
-                            "originalFile": filename,
-                            "productType": product_type,
-                            "productCode": product_code,
-                            "similarFile": result['imageUrl'],
-                            "confidence_score": result.get('confidence_score', 0),
-                            "similarity_percentage": result.get('similarity_percentage', 0)
-                        }
-                        formatted_results.append(formatted_result)
-                    elif indexName == "product-carmodelclean":
-                        # Change the pattern for other_index
-                        model_cars = str(result['title']).split("-")[0]
-                        formatted_result = {
-                            "modelName": indexName,
-                            "originalFile": filename,
-                            "modelCars": model_cars,
-                            "similarFile": result['imageUrl'],
-                            "similarity_percentage": result.get('similarity_percentage', 0)
-                        }
-                        formatted_results.append(formatted_result)
-                    elif indexName == "product-carmodel-type-code-used":
-                        # Change the pattern for other_index with error handling
-                        title_parts = str(result['title']).split(".")
-                        
-                        # Ensure we have at least 3 parts, otherwise use defaults
-                        model_cars = title_parts[0] if len(title_parts) > 0 else "Unknown"
-                        product_type = title_parts[1] if len(title_parts) > 1 else "Unknown"  
-                        product_code = title_parts[2] if len(title_parts) > 2 else "Unknown"
-                        
-                        formatted_result = {
-                            "modelName": indexName,
-                            "originalFile": filename,
-                            "modelCars": model_cars,
-                            "productType": product_type,
-                            "productCode": product_code,
-                            "similarFile": result['imageUrl'],
-                            "similarity_percentage": result.get('similarity_percentage', 0),
-                            "title_format": f"Parts found: {len(title_parts)} (expected: 3)"
-                        }
-                        formatted_results.append(formatted_result)
-
-                formatted_results_all.append(formatted_results)
-
+                formatted_results_all.append(
+                    search_file(image_search_api, indexName, file, fields, compact, deadline)
+                )
             except KeyError:
                 # Handle missing file or indexName
                 return jsonify({"error": "Missing file or indexName parameter"}), 400
 
-            except Exception as e:
-                # Handle other exceptions for individual files with detailed logging
-                import traceback
-                error_details = {
-                    "error": f"ML service error: An error occurred while processing file {file.filename}: {str(e)}",
-                    "file": file.filename,
-                    "index": indexName,
-                    "error_type": type(e).__name__,
-                    "traceback": traceback.format_exc()
-                }
-                
-                # Log the error for debugging
-                print(f"ERROR processing {file.filename}: {error_details}")
-                
-                formatted_results_all.append(error_details)
-
-        return jsonify(formatted_results_all)
+        return json_response(formatted_results_all, request.headers.get('Accept-Encoding'))
 
     except KeyError:
         # Handle missing indexName or topK
         return jsonify({"error": "Missing indexName or topK parameter"}), 400
 
+    except RequestEntityTooLarge as e:
+        # A file or the whole upload is over the configured byte limits
+        return jsonify({"error": e.description}), HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
     except Exception as e:
         # Handle other exceptions for the entire request
         error_message = "An error occurred while processing the request: {}".format(str(e))
         return jsonify({"error": error_message}), 500
 
 
+@app.route('/search/raw', methods=['POST'])
+def search_raw():
+    """Search a single image sent as the raw request body.
+
+    indexName, topK and filename come from the query string or the X-Index-Name,
+    X-Top-K and X-Filename headers. The response is the file's result list.
+    """
+    try:
+        indexName = request.args.get('indexName') or request.headers.get('X-Index-Name')
+        if not indexName:
+            return jsonify({"error": "Missing indexName parameter"}), 400
+
+        topK = parse_topK(request.args.get('topK') or request.headers.get('X-Top-K'))
+        if topK is None:
+            return jsonify({"error": "Invalid topK parameter. It must be a valid integer."}), 400
+
+        try:
+            deadline = request_deadline()
+        except ValueError:
+            return jsonify({"error": "Invalid request timeout or deadline."}), 400
+
+        fields = parse_fields(request.args.get('fields'))
+        compact = request.args.get('format', '').lower() == 'compact'
+        capture_request_shape(fields, compact, deadline)
+        filename = request.args.get('filename') or request.headers.get('X-Filename') or 'upload.jpg'
+
+        # Same bounded, spooled buffer as multipart uploads
+        with BoundedSpooledFile() as body:
+            shutil.copyfileobj(request.stream, body)
+            if body.bytes_written == 0:
+                return jsonify({"error": "Empty request body"}), 400
+            file = FileStorage(stream=body, filename=filename)
+
+            image_search_api = ImageSearchAPI(indexName=indexName, topK=topK)
+            formatted_results = search_file(image_search_api, indexName, file, fields, compact, deadline)
+
+        if isinstance(formatted_results, dict) and "error" in formatted_results:
+            if formatted_results.get("error_type") == "DeadlineExceeded":
+                return jsonify(formatted_results), HTTP_504_GATEWAY_TIMEOUT
+            return jsonify(formatted_results), HTTP_502_BAD_GATEWAY
+        return json_response(formatted_results, request.headers.get('Accept-Encoding'))
+
+    except RequestEntityTooLarge as e:
+        return jsonify({"error": e.description}), HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+    except Exception as e:
+        error_message = "An error occurred while processing the request: {}".format(str(e))
+        return jsonify({"error": error_message}), 500
+
+
+def unpack_single(unpacker):
+    """Decode exactly one object from unpacker, raising ExtraData like unpackb when more follows"""
+    payload = unpacker.unpack()
+    try:
+        unpacker.skip()
+    except msgpack.OutOfData:
+        return payload
+    raise msgpack.ExtraData(payload, b"")
+
+
+def parse_batch_images(payload):
+    """(name, data) pairs of a /search/batch payload; ValueError describes a malformed one"""
+    if not isinstance(payload, dict):
+        raise ValueError("Request body must be a MessagePack map")
+    images = payload.get('images') or []
+    if not isinstance(images, list):
+        raise ValueError("images must be a list")
+    parsed = []
+    for position, image in enumerate(images):
+        if not isinstance(image, dict):
+            raise ValueError(f"images[{position}] must be a map with name and data")
+        name = image.get('name') or f"image-{position}.jpg"
+        data = image.get('data') or b""
+        if not isinstance(name, str):
+            raise ValueError(f"images[{position}].name must be a string")
+        if not isinstance(data, bytes):
+            raise ValueError(f"images[{position}].data must be binary")
+        parsed.append((name, data))
+    return parsed
+
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    """MessagePack batch search for machine clients.
+
+    The body is a MessagePack map {"indexName", "topK", "images": [{"name", "data"}]}
+    with optional "fields" and "format". The answer has the same shape as /search and is
+    MessagePack when the client accepts application/msgpack, JSON otherwise.
+
+    The body is decoded straight from the request stream, so it is never held twice;
+    it is capped at UPLOAD_MAX_BATCH_BYTES and each image at UPLOAD_MAX_FILE_BYTES.
+    """
+    try:
+        if msgpack is None:
+            return jsonify({"error": "MessagePack support is not installed"}), HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        if request.mimetype not in MSGPACK_MIMETYPES:
+            return jsonify({"error": "Content-Type must be application/msgpack"}), HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+        # Applies to chunked bodies too: reading past the cap raises RequestEntityTooLarge
+        request.max_content_length = MAX_BATCH_BYTES
+        # The decoder only buffers bytes it has not consumed yet, so the buffer fills up
+        # only for a single image well above MAX_FILE_BYTES
+        unpacker = msgpack.Unpacker(request.stream, raw=False, max_buffer_size=MAX_FILE_BYTES + 64 * 1024)
+        try:
+            payload = unpack_single(unpacker)
+        except msgpack.BufferFull:
+            return jsonify({"error": f"An image exceeds the limit of {MAX_FILE_BYTES} bytes"}), \
+                HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        except RequestEntityTooLarge:
+            raise
+        except Exception:
+            # ExtraData, FormatError, StackError, invalid UTF-8 in strings...
+            return jsonify({"error": "Request body is not valid MessagePack"}), 400
+        try:
+            images = parse_batch_images(payload)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        indexName = payload.get('indexName')
+        topK = parse_topK(payload.get('topK'))
+        if not indexName or topK is None:
+            return jsonify({"error": "Missing indexName or invalid topK parameter"}), 400
+
+        fields = payload.get('fields')
+        if isinstance(fields, str):
+            fields = parse_fields(fields)
+        elif fields is not None and not (isinstance(fields, list) and all(isinstance(field, str) for field in fields)):
+            return jsonify({"error": "fields must be a string or a list of strings"}), 400
+        compact = str(payload.get('format', '')).lower() == 'compact'
+        try:
+            deadline = request_deadline()
+        except ValueError:
+            return jsonify({"error": "Invalid request timeout or deadline."}), 400
+        capture_request_shape(fields, compact, deadline)
+
+        image_search_api = ImageSearchAPI(indexName=indexName, topK=topK)
+        formatted_results_all = []
+        for name, data in images:
+            if len(data) > MAX_FILE_BYTES:
+                formatted_results_all.append({"error": f"File {name} exceeds the limit of {MAX_FILE_BYTES} bytes"})
+                continue
+            file = FileStorage(stream=io.BytesIO(data), filename=name)
+            formatted_results_all.append(search_file(image_search_api, indexName, file, fields, compact, deadline))
+
+        if accepts_msgpack(request.headers.get('Accept')):
+            return msgpack_response(formatted_results_all)
+        return json_response(formatted_results_all, request.headers.get('Accept-Encoding'))
+
+    except RequestEntityTooLarge as e:
+        return jsonify({"error": e.description}), HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+    except Exception as e:
+        error_message = "An error occurred while processing the request: {}".format(str(e))
+        return jsonify({"error": error_message}), 500
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
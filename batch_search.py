@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Batch image search from the command line.
+
+Searches every image of a directory (or of a manifest file listing image paths, one
+per line) directly through ImageSearchAPI, without going through the /search endpoint,
+and streams the formatted results to a CSV or JSONL file.
+
+    python batch_search.py /data/photos --index product-pro-type-code-part --top-k 5 \\
+        --output results.jsonl --workers 16
+
+Every successfully searched file is appended to a checkpoint file (OUTPUT.checkpoint by
+default) and skipped when the same command is run again, so an interrupted run resumes
+where it stopped. Failed files are written to the output with their error and retried
+on the next run.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+from ImageSearch import ImageSearchAPI
+from search_response import ORIGINAL_FILE_BASE_URL, format_search_results
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+
+
+def iter_images(source, recursive=True):
+    """Yield (path, name) pairs; name is the path relative to the source directory"""
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, filename)
+                    yield path, os.path.relpath(path, source)
+            if not recursive:
+                break
+    else:
+        # Manifest: one image path per line, relative paths are relative to the manifest
+        base_dir = os.path.dirname(os.path.abspath(source))
+        with open(source) as manifest:
+            for line in manifest:
+                entry = line.strip()
+                if not entry or entry.startswith("#"):
+                    continue
+                path = entry if os.path.isabs(entry) else os.path.join(base_dir, entry)
+                yield path, entry
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as checkpoint:
+        return {line.rstrip("\n") for line in checkpoint if line.strip()}
+
+
+class ResultWriter:
+    """Appends one JSON line per file, or one CSV row per hit, flushing after every file"""
+
+    def __init__(self, path, output_format, index_name):
+        self.output_format = output_format
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "a", newline="")
+        self.csv_writer = None
+        if output_format == "csv":
+            # Column names come from the formatting used by /search for this index
+            sample = format_search_results(index_name, "", [{"title": "a-b.c", "imageUrl": ""}])
+            hit_fields = list(sample[0].keys()) if sample else ["title", "imageUrl", "confidence_score",
+                                                               "similarity_percentage"]
+            self.csv_writer = csv.DictWriter(self.file, fieldnames=["file", "rank", "error"] + hit_fields,
+                                             extrasaction="ignore")
+            if not exists:
+                self.csv_writer.writeheader()
+
+    def write(self, name, hits=None, error=None):
+        if self.output_format == "jsonl":
+            record = {"file": name, "error": error} if error else {"file": name, "results": hits}
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        elif error:
+            self.csv_writer.writerow({"file": name, "error": error})
+        else:
+            for rank, hit in enumerate(hits, start=1):
+                self.csv_writer.writerow({"file": name, "rank": rank, **hit})
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def search_one(image_search_api, index_name, path, name):
+    # The name (relative path) keeps equal file names in different folders apart in the output
+    with open(path, "rb") as image_file:
+        file_storage = FileStorage(stream=image_file, filename=name)
+        results = image_search_api.search_image_file(file_storage)
+    # None means vectorize or search failed (an outage, not an image without matches), so the
+    # file is reported as failed and left out of the checkpoint to be retried on the next run
+    if results is None:
+        raise RuntimeError("Vectorize or search failed")
+    original_file = ORIGINAL_FILE_BASE_URL + str(secure_filename(name))
+    formatted = format_search_results(index_name, original_file, results)
+    # Indexes without a known title format get the raw results instead of nothing
+    return formatted if formatted or not results else results
+
+
+def run(args):
+    output_format = args.format or ("csv" if args.output.lower().endswith(".csv") else "jsonl")
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint"
+    done = load_checkpoint(checkpoint_path)
+
+    # Every search makes Vision and Search calls (plus hedges) on the shared hedging pool,
+    # and the Vision session needs a pooled connection per concurrent call to avoid re-handshakes
+    os.environ.setdefault("HEDGE_MAX_WORKERS", str(max(32, args.workers * 4)))
+    os.environ.setdefault("HTTP_POOL_MAXSIZE", str(max(10, args.workers * 2)))
+    image_search_api = ImageSearchAPI(indexName=args.index, topK=args.top_k)
+    writer = ResultWriter(args.output, output_format, args.index)
+    checkpoint = open(checkpoint_path, "a")
+
+    counts = {"searched": 0, "failed": 0, "skipped": 0}
+    start_time = time.time()
+
+    def report():
+        elapsed = time.time() - start_time
+        rate = counts["searched"] / elapsed if elapsed else 0.0
+        print(f"searched {counts['searched']}, failed {counts['failed']}, "
+              f"skipped {counts['skipped']} ({rate:.1f} images/s)", file=sys.stderr)
+
+    def finish(future, name):
+        try:
+            hits = future.result()
+            error = None
+        except Exception as e:
+            hits, error = None, str(e)
+        # Only called from the main thread, so output and checkpoint need no locking
+        writer.write(name, hits=hits, error=error)
+        if error:
+            counts["failed"] += 1
+        else:
+            checkpoint.write(name + "\n")
+            checkpoint.flush()
+            counts["searched"] += 1
+        if (counts["searched"] + counts["failed"]) % args.progress_every == 0:
+            report()
+
+    pending = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for path, name in iter_images(args.input, recursive=not args.no_recursive):
+                if name in done:
+                    counts["skipped"] += 1
+                    continue
+                # Keep a bounded number of files in flight so huge inputs don't queue up in memory
+                while len(pending) >= args.workers * 2:
+                    completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        finish(future, pending.pop(future))
+                pending[executor.submit(search_one, image_search_api, args.index, path, name)] = name
+
+            completed, _ = wait(pending)
+            for future in completed:
+                finish(future, pending.pop(future))
+    finally:
+        writer.close()
+        checkpoint.close()
+        report()
+
+    return 0 if counts["failed"] == 0 else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="directory of images, or a manifest file with one image path per line")
+    parser.add_argument("--index", required=True, help="search index name, as indexName for /search")
+    parser.add_argument("--top-k", type=int, default=5, help="results per image (default 5)")
+    parser.add_argument("--output", required=True, help="output file, .csv or .jsonl")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="output format (default from --output)")
+    parser.add_argument("--workers", type=int, default=8, help="images searched in parallel (default 8)")
+    parser.add_argument("--checkpoint", help="checkpoint file (default OUTPUT.checkpoint)")
+    parser.add_argument("--no-recursive", action="store_true", help="do not descend into subdirectories")
+    parser.add_argument("--progress-every", type=int, default=100, help="log progress every N images")
+    parser.add_argument("--log-level", default="WARNING", help="log level (default WARNING)")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.progress_every < 1:
+        parser.error("--progress-every must be at least 1")
+
+    # Configure logging before ImageSearchAPI does, its per-call INFO logs are too chatty here
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s [%(levelname)s] %(message)s")
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
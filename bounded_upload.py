@@ -0,0 +1,45 @@
+"""
+Bounded-memory multipart ingestion.
+
+Every uploaded file part is written into a SpooledTemporaryFile that stays in memory
+up to UPLOAD_SPOOL_THRESHOLD bytes and spills to an anonymous temp file above it.
+A part larger than UPLOAD_MAX_FILE_BYTES aborts parsing with 413 as soon as the limit
+is crossed, and Flask's MAX_CONTENT_LENGTH caps the whole request body.
+
+MessagePack batches are decoded in memory, so /search/batch lowers that cap to
+UPLOAD_MAX_BATCH_BYTES for its own requests.
+
+Spilled files are unlinked on creation and closed by Flask at the end of the request,
+so no temp space outlives a request on any path.
+"""
+
+import os
+import tempfile
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(200 * 1024 * 1024)))
+MAX_BATCH_BYTES = int(os.getenv("UPLOAD_MAX_BATCH_BYTES", str(64 * 1024 * 1024)))
+SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", str(1024 * 1024)))
+
+
+class BoundedSpooledFile(tempfile.SpooledTemporaryFile):
+    def __init__(self, max_bytes=MAX_FILE_BYTES, spool_threshold=SPOOL_THRESHOLD):
+        super().__init__(max_size=spool_threshold, mode="w+b")
+        self.max_bytes = max_bytes
+        self.bytes_written = 0
+
+    def write(self, s):
+        self.bytes_written += len(s)
+        if self.bytes_written > self.max_bytes:
+            raise RequestEntityTooLarge(f"Uploaded file exceeds the limit of {self.max_bytes} bytes")
+        return super().write(s)
+
+
+class BoundedRequest(Request):
+    """Request class that parses file parts into size-capped spooled buffers"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BoundedSpooledFile()
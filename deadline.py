@@ -0,0 +1,81 @@
+"""
+End-to-end request deadlines.
+
+A caller sends a time budget (X-Request-Timeout: seconds, or X-Deadline: unix epoch
+seconds). Every pipeline stage derives its own timeout from what is left of it, stages
+that cannot finish in the remaining time are skipped, and waiting stops once the
+deadline has passed.
+
+Budgets are capped at REQUEST_DEADLINE_MAX_SECONDS (by default GUNICORN_TIMEOUT, after
+which the worker is killed anyway), so a huge value cannot overflow a wait timeout.
+"""
+
+import math
+import os
+import threading
+import time
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def max_seconds():
+    """Largest accepted budget; threading.TIMEOUT_MAX bounds what waits can take"""
+    limit = os.getenv("REQUEST_DEADLINE_MAX_SECONDS") or os.getenv("GUNICORN_TIMEOUT", "120")
+    return min(float(limit), threading.TIMEOUT_MAX)
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_request(cls, timeout=None, epoch_deadline=None):
+        """Build a deadline from a timeout in seconds or an absolute epoch time.
+
+        Falls back to REQUEST_DEADLINE_SECONDS when neither is given; returns None
+        when no deadline applies. Malformed values, nan and inf raise ValueError. A
+        deadline that has already passed (or a budget of zero or less) gives an expired
+        Deadline, so the request is answered as timed out rather than as malformed.
+        """
+        candidates = []
+        if timeout not in (None, ""):
+            candidates.append(float(timeout))
+        if epoch_deadline not in (None, ""):
+            candidates.append(float(epoch_deadline) - time.time())
+        if not candidates:
+            default = os.getenv("REQUEST_DEADLINE_SECONDS")
+            if not default:
+                return None
+            candidates.append(float(default))
+        if not all(math.isfinite(candidate) for candidate in candidates):
+            raise ValueError(f"Deadline must be a finite number of seconds, got {min(candidates)}")
+        return cls(min(max(0.0, min(candidates)), max_seconds()))
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def timeout(self, cap=None):
+        """Timeout for one call: the remaining budget, never more than cap"""
+        remaining = self.remaining()
+        return remaining if cap is None else min(cap, remaining)
+
+    def check(self, stage, needed=0.0):
+        """Raise DeadlineExceeded if stage cannot start and still finish in time"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline exceeded before {stage}")
+        if needed and remaining < needed:
+            raise DeadlineExceeded(
+                f"Skipping {stage}: {remaining:.2f}s left, typically needs {needed:.2f}s"
+            )
+
+
+def timeout_for(deadline, cap=None):
+    """Per-call timeout when deadline may be None"""
+    return cap if deadline is None else deadline.timeout(cap)
@@ -13,3 +13,7 @@ bind = f"0.0.0.0:{port}"
 forwarded_allow_ips = '*'
 
 secure_scheme_headers = {'X-Forwarded-Proto': 'https'}
+
+
+# Post-fork client reset and warm-up
+from gunicorn_hooks import post_fork, post_worker_init  # noqa: E402,F401
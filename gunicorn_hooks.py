@@ -0,0 +1,23 @@
+"""
+Gunicorn server hooks only, no server settings.
+
+startup.sh loads this with --config so the production flags stay exactly what the
+script passes; gunicorn_config.py imports the same hooks for deployments that use it.
+"""
+
+
+def post_fork(server, worker):
+    # With --preload the app is imported in the master; make sure no client or
+    # socket created there is shared with the forked worker
+    from ImageSearch import reset_clients
+    reset_clients()
+
+
+def post_worker_init(worker):
+    # Runs in the worker before it accepts connections, so it only serves once warm
+    import memory_stats
+    from warmup import warm_up
+    # Start tracemalloc (if enabled) before warm-up so the first snapshot includes the warm clients
+    memory_stats.ensure_started()
+    status = warm_up()
+    worker.log.info(f"Worker {worker.pid} warm-up {status['status']} in {status['total_seconds']} seconds")
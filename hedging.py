@@ -0,0 +1,240 @@
+"""
+Latency-aware, hedged calls across several endpoints of one service.
+
+Each EndpointPool keeps recent latencies per endpoint and sends a call to the endpoint
+with the lowest recent latency. If no good answer has arrived after that endpoint's
+p95 latency, a duplicate request is sent to the next endpoint (or the same one when
+only one is configured) and the first good answer wins. A failed call fails over once.
+
+A call "fails" when it raises or returns None, matching how ImageSearchAPI reports errors.
+A call that raises ClientError got a definite answer that another endpoint would repeat
+(a 4xx for a bad image or query): it is neither counted against the endpoint nor
+failed over or hedged, and the pool returns None for it.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import request_profiler
+
+logger = logging.getLogger(__name__)
+
+LATENCY_WINDOW = 200
+
+# 4xx answers that say something about the endpoint (credentials, throttling, timeouts)
+# rather than about the request, so another replica may well succeed
+RETRYABLE_CLIENT_STATUSES = (401, 403, 408, 429)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                max_workers = int(os.getenv("HEDGE_MAX_WORKERS", "32"))
+                _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+    return _executor
+
+
+class ClientError(Exception):
+    """Raised by a pool call for a non-retryable answer, see is_client_error"""
+
+
+def is_client_error(status_code):
+    return status_code is not None and 400 <= status_code < 500 and status_code not in RETRYABLE_CLIENT_STATUSES
+
+
+_CLIENT_ERROR = object()
+
+
+def parse_endpoints(urls_value, keys_value, fallback_url=None, fallback_key=None):
+    """Build [{"url", "key"}] from comma separated URL and key lists.
+
+    A single key is used for every URL; without a URL list the single fallback URL is used.
+    """
+    urls = [url.strip() for url in (urls_value or "").split(",") if url.strip()]
+    keys = [key.strip() for key in (keys_value or "").split(",") if key.strip()]
+    if not urls:
+        urls = [fallback_url] if fallback_url else []
+    if not keys:
+        keys = [fallback_key]
+    if len(keys) == 1:
+        keys = keys * len(urls)
+    if len(keys) != len(urls):
+        raise ValueError("Number of endpoint keys does not match the number of endpoints")
+    return [{"url": url, "key": key} for url, key in zip(urls, keys)]
+
+
+class Endpoint:
+    def __init__(self, target):
+        self.target = target
+        self.name = target["url"]
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.errors = 0
+        self.wins = 0
+        self.ewma = None
+
+    def record(self, latency, ok, failure_penalty):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+            # Penalise failing endpoints so routing moves away from them
+            latency = max(latency, failure_penalty)
+        self.latencies.append(latency)
+        self.ewma = latency if self.ewma is None else 0.8 * self.ewma + 0.2 * latency
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self):
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        return {
+            "endpoint": self.name,
+            "requests": self.requests,
+            "errors": self.errors,
+            "wins": self.wins,
+            "ewma_ms": round(self.ewma * 1000, 1) if self.ewma is not None else None,
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
+
+
+class EndpointPool:
+    def __init__(self, service, targets, hedge_enabled=None):
+        if not targets:
+            raise ValueError(f"No endpoints configured for {service}")
+        self.service = service
+        self.endpoints = [Endpoint(target) for target in targets]
+        if hedge_enabled is None:
+            hedge_enabled = os.getenv("HEDGE_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = float(os.getenv("HEDGE_PERCENTILE", "95"))
+        self.min_samples = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+        self.default_delay = float(os.getenv("HEDGE_DEFAULT_DELAY_MS", "2000")) / 1000.0
+        self.min_delay = float(os.getenv("HEDGE_MIN_DELAY_MS", "50")) / 1000.0
+        self.explore_rate = float(os.getenv("HEDGE_EXPLORE_RATE", "0.05"))
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "failovers": 0, "failures": 0,
+                       "deadline_exceeded": 0, "client_errors": 0}
+
+    def hedge_delay(self, endpoint):
+        """Wait this long for endpoint before sending a duplicate: its recent p95 latency"""
+        if len(endpoint.latencies) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, endpoint.percentile(self.hedge_percentile))
+
+    def expected_latency(self):
+        """Median latency of the fastest endpoint, 0 while nothing has been measured"""
+        with self._lock:
+            medians = [endpoint.percentile(50) for endpoint in self.endpoints if endpoint.latencies]
+        return min(medians) if medians else 0.0
+
+    def _ranked(self):
+        # Endpoints without measurements go first so every replica gets sampled, and a
+        # small share of calls is sent to a random replica so a recovered one is noticed
+        with self._lock:
+            ranked = sorted(self.endpoints, key=lambda endpoint: endpoint.ewma or 0.0)
+        if len(ranked) > 1 and random.random() < self.explore_rate:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    def _run(self, func, endpoint):
+        start_time = time.time()
+        try:
+            value = func(endpoint.target)
+        except ClientError as e:
+            # The endpoint answered correctly, the request itself is bad
+            logger.warning(f"{self.service} call to {endpoint.name} rejected the request: {str(e)}")
+            with self._lock:
+                endpoint.record(time.time() - start_time, True, self.default_delay)
+            return _CLIENT_ERROR
+        except Exception as e:
+            logger.warning(f"{self.service} call to {endpoint.name} failed: {str(e)}")
+            value = None
+        with self._lock:
+            endpoint.record(time.time() - start_time, value is not None, self.default_delay)
+        return value
+
+    def call(self, func, deadline=None):
+        """Run func(target) on the best endpoint, hedging once if it is slow or failing.
+
+        With a deadline, waiting stops when it passes and None is returned; func is
+        expected to bound its own request timeouts by the same deadline.
+        """
+        ranked = self._ranked()
+        primary = ranked[0]
+        secondary = ranked[1] if len(ranked) > 1 else ranked[0]
+
+        executor = _get_executor()
+        run = request_profiler.wrap(self._run)
+        futures = {executor.submit(run, func, primary): primary}
+        second_future = None
+        delay = self.hedge_delay(primary) if self.hedge_enabled else None
+
+        with self._lock:
+            self._stats["calls"] += 1
+
+        while futures:
+            timeout = delay
+            if deadline is not None:
+                timeout = deadline.remaining() if timeout is None else min(timeout, deadline.remaining())
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                endpoint = futures.pop(future)
+                value = future.result()
+                if value is _CLIENT_ERROR:
+                    # Any other endpoint would give the same answer, don't fail over or hedge
+                    with self._lock:
+                        self._stats["client_errors"] += 1
+                    return None
+                if value is not None:
+                    with self._lock:
+                        endpoint.wins += 1
+                        if future is second_future:
+                            self._stats["hedge_wins"] += 1
+                    return value
+
+            if deadline is not None and deadline.expired():
+                with self._lock:
+                    self._stats["deadline_exceeded"] += 1
+                return None
+
+            if second_future is None and (done or self.hedge_enabled):
+                # Primary failed (fail over) or is slower than its p95 (hedge)
+                with self._lock:
+                    self._stats["failovers" if done and not futures else "hedged"] += 1
+                second_future = executor.submit(run, func, secondary)
+                futures[second_future] = secondary
+                delay = None
+
+        with self._lock:
+            self._stats["failures"] += 1
+        return None
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["endpoints"] = []
+            for endpoint in self.endpoints:
+                endpoint_stats = endpoint.stats()
+                endpoint_stats["hedge_delay_ms"] = round(self.hedge_delay(endpoint) * 1000, 1)
+                stats["endpoints"].append(endpoint_stats)
+        calls = stats["calls"]
+        stats["hedge_rate"] = round(stats["hedged"] / calls, 4) if calls else 0.0
+        stats["hedge_win_rate"] = round(stats["hedge_wins"] / stats["hedged"], 4) if stats["hedged"] else 0.0
+        stats["hedge_enabled"] = self.hedge_enabled
+        return stats
@@ -0,0 +1,272 @@
+"""
+Memory growth instrumentation for long-lived workers.
+
+Three signals, all per worker process:
+
+    per-request RSS     resident set size before and after every request, aggregated
+                        per endpoint (MEMORY_STATS_ENABLED, on by default). With several
+                        threads per worker a delta also includes concurrent requests,
+                        so read it as a per-endpoint trend rather than an exact cost.
+    tracemalloc         when TRACEMALLOC_ENABLED=1, a snapshot every
+                        TRACEMALLOC_INTERVAL_SECONDS, diffed by allocation site against
+                        the previous and the first snapshot. Costs CPU and memory, keep
+                        it off unless chasing a leak.
+    live objects        ImageSearchAPI instances (registered on creation) and, on
+                        demand, SDK clients, sessions and connection pools found by gc.
+
+Growth that keeps climbing in "since_start" while the live object counts stay flat
+points at a cache or buffer; growing object counts point at clients created per request.
+"""
+
+import collections
+import gc
+import logging
+import os
+import threading
+import time
+import tracemalloc
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Object types worth counting when looking for clients or buffers that pile up
+TRACKED_TYPES = (
+    "ImageSearchAPI",
+    "SearchClient",
+    "BlobServiceClient",
+    "ContainerClient",
+    "BlobClient",
+    "Session",
+    "HTTPAdapter",
+    "PoolManager",
+    "HTTPConnectionPool",
+    "HTTPSConnectionPool",
+    "EndpointPool",
+    "SpooledTemporaryFile",
+    "BoundedSpooledFile",
+    "SamplingProfiler",
+)
+
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+_api_instances = weakref.WeakSet()
+_api_created = 0
+_api_lock = threading.Lock()
+
+
+def _env_flag(name, default):
+    return os.getenv(name, default).lower() in ("1", "true", "yes", "on")
+
+
+def rss_bytes():
+    """Current resident set size of this process, None where /proc is unavailable"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _page_size
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def register_api(instance):
+    """Called by ImageSearchAPI.__init__ so live instances can be counted"""
+    global _api_created
+    with _api_lock:
+        _api_instances.add(instance)
+        _api_created += 1
+
+
+def count_objects(type_names=TRACKED_TYPES):
+    """Live objects per tracked type name; walks every gc object, admin use only"""
+    wanted = set(type_names)
+    counts = collections.Counter()
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        if name in wanted:
+            counts[name] += 1
+    return dict(sorted(counts.items()))
+
+
+class RequestMemoryStats:
+    """RSS growth per endpoint, fed from before/after_request"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.started_rss = rss_bytes()
+        self.peak_rss = self.started_rss or 0
+
+    def record(self, endpoint, before, after):
+        if before is None or after is None:
+            return
+        delta = after - before
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    "requests": 0,
+                    "grew": 0,
+                    "total_delta_bytes": 0,
+                    "max_delta_bytes": 0,
+                }
+            stats["requests"] += 1
+            stats["total_delta_bytes"] += delta
+            if delta > 0:
+                stats["grew"] += 1
+                stats["max_delta_bytes"] = max(stats["max_delta_bytes"], delta)
+            self.peak_rss = max(self.peak_rss, after)
+
+    def get_stats(self):
+        current = rss_bytes()
+        with self.lock:
+            endpoints = {
+                endpoint: {
+                    **stats,
+                    "mean_delta_bytes": round(stats["total_delta_bytes"] / stats["requests"]),
+                }
+                for endpoint, stats in self.endpoints.items()
+            }
+            return {
+                "pid": os.getpid(),
+                "rss_bytes": current,
+                "peak_rss_bytes": max(self.peak_rss, current or 0),
+                "rss_growth_bytes": current - self.started_rss if current and self.started_rss else None,
+                "endpoints": endpoints,
+            }
+
+
+class TracemallocSampler:
+    """Periodic tracemalloc snapshots, compared by allocation site"""
+
+    def __init__(self, interval, frames=1, top=25):
+        self.interval = interval
+        self.frames = frames
+        self.top = top
+        self.lock = threading.Lock()
+        self.first = None
+        self.previous = None
+        self.latest = None
+        self.latest_at = None
+        self.snapshots = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.take_snapshot()
+        self._thread = threading.Thread(target=self._run, name="tracemalloc-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.take_snapshot()
+            except Exception as e:
+                logger.warning(f"tracemalloc snapshot failed: {str(e)}")
+
+    def take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+        with self.lock:
+            if self.first is None:
+                self.first = snapshot
+            self.previous, self.latest = self.latest, snapshot
+            self.latest_at = time.time()
+            self.snapshots += 1
+
+    def _diff(self, newer, older, limit):
+        if newer is None or older is None:
+            return []
+        return [
+            {
+                "site": str(stat.traceback),
+                "size_diff_bytes": stat.size_diff,
+                "size_bytes": stat.size,
+                "count_diff": stat.count_diff,
+            }
+            for stat in newer.compare_to(older, "traceback" if self.frames > 1 else "lineno")[:limit]
+        ]
+
+    def get_stats(self, limit=None):
+        limit = limit or self.top
+        with self.lock:
+            current, peak = tracemalloc.get_traced_memory()
+            return {
+                "interval_seconds": self.interval,
+                "snapshots": self.snapshots,
+                "latest_at": self.latest_at,
+                "traced_bytes": current,
+                "traced_peak_bytes": peak,
+                "since_previous": self._diff(self.latest, self.previous, limit),
+                "since_start": self._diff(self.latest, self.first, limit),
+            }
+
+
+request_stats = None
+_sampler = None
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def ensure_started():
+    """Set up per-process state once per worker; with --preload the master's copy is replaced after fork"""
+    global request_stats, _sampler, _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        request_stats = RequestMemoryStats()
+        _sampler = None
+        if _env_flag("TRACEMALLOC_ENABLED", "0"):
+            _sampler = TracemallocSampler(
+                interval=float(os.getenv("TRACEMALLOC_INTERVAL_SECONDS", "300")),
+                frames=int(os.getenv("TRACEMALLOC_FRAMES", "1")),
+                top=int(os.getenv("TRACEMALLOC_TOP", "25")),
+            ).start()
+            logger.info(f"tracemalloc sampling every {_sampler.interval} seconds")
+        _started_pid = os.getpid()
+
+
+def is_enabled():
+    return _env_flag("MEMORY_STATS_ENABLED", "1")
+
+
+def get_api_counts():
+    with _api_lock:
+        return {"live": len(_api_instances), "created": _api_created}
+
+
+def get_stats():
+    """Cheap summary for /stats/memory"""
+    ensure_started()
+    return {
+        **request_stats.get_stats(),
+        "image_search_api": get_api_counts(),
+        "gc_counts": gc.get_count(),
+        "tracemalloc": _sampler is not None,
+    }
+
+
+def get_report(limit=None, snapshot=False, collect=False):
+    """Full report for /admin/memory, including a gc walk and tracemalloc diffs"""
+    ensure_started()
+    if snapshot and _sampler is not None:
+        _sampler.take_snapshot()
+    report = get_stats()
+    if collect:
+        report["gc_collected"] = gc.collect()
+        report["rss_after_collect_bytes"] = rss_bytes()
+    report["objects"] = count_objects()
+    report["gc_garbage"] = len(gc.garbage)
+    if _sampler is not None:
+        report["tracemalloc"] = _sampler.get_stats(limit)
+    return report
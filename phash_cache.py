@@ -0,0 +1,275 @@
+"""
+Perceptual-hash near-duplicate cache for image embeddings.
+
+Re-shot or re-compressed photos of the same part are not byte-identical but have
+almost the same 64-bit difference hash (dHash). Recently seen hashes are kept in a
+multi-index hash table so any stored hash within PHASH_MAX_DISTANCE bits of a new
+upload is found without scanning, and its embedding (optionally its search results)
+is reused instead of calling Azure AI Vision again.
+
+The cache lives in process memory, so every gunicorn worker keeps its own.
+
+PHASH_MODE selects what a hit does:
+
+    off     no hashing (default)
+    shadow  hash and look up, but always vectorize and audit every hit against the
+            fresh embedding without reusing it; /stats/phash then shows the hit rate
+            and false-hit rate reuse would have had
+    reuse   serve hits from the cache, auditing PHASH_AUDIT_RATE of them
+
+A different part shot on the same background can fall within the distance and silently
+get another image's embedding, so run shadow first and switch to reuse only once the
+measured false-hit rate is acceptable. PHASH_ENABLED=1 is kept as an alias for reuse.
+"""
+
+import io
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # Pillow not installed, the perceptual-hash stage is disabled
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+
+def dhash(image_data):
+    """64-bit difference hash of an image given as bytes or a binary file object"""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        image_data = io.BytesIO(image_data)
+    with Image.open(image_data) as image:
+        # Let the JPEG decoder downscale while decoding, we only need 9x8 pixels
+        image.draft("L", (64, 64))
+        small = image.convert("L").resize((9, 8), Image.BILINEAR)
+        pixels = list(small.getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left < right else 0)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class MultiIndexHashTable:
+    """Hamming-distance index using multi-index hashing.
+
+    The hash is split into max_distance + 1 disjoint chunks. Two hashes within
+    max_distance bits of each other must agree exactly on at least one chunk
+    (pigeonhole), so only entries sharing a chunk value are compared.
+    """
+
+    def __init__(self, max_distance, bits=HASH_BITS):
+        chunk_count = max(1, min(max_distance + 1, bits))
+        base, extra = divmod(bits, chunk_count)
+        self.chunks = []
+        offset = 0
+        for i in range(chunk_count):
+            width = base + (1 if i < extra else 0)
+            self.chunks.append((offset, (1 << width) - 1))
+            offset += width
+        self.tables = [{} for _ in self.chunks]
+
+    def _keys(self, value):
+        return [(value >> offset) & mask for offset, mask in self.chunks]
+
+    def add(self, value, entry_id):
+        for table, key in zip(self.tables, self._keys(value)):
+            table.setdefault(key, set()).add(entry_id)
+
+    def remove(self, value, entry_id):
+        for table, key in zip(self.tables, self._keys(value)):
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del table[key]
+
+    def candidates(self, value):
+        found = set()
+        for table, key in zip(self.tables, self._keys(value)):
+            found.update(table.get(key, ()))
+        return found
+
+
+class PerceptualHashCache:
+    def __init__(self, max_distance=4, capacity=5000, audit_rate=0.05, audit_min_similarity=0.95,
+                 reuse_results=False, results_ttl=300, shadow=False):
+        self.max_distance = max_distance
+        self.capacity = capacity
+        self.shadow = shadow
+        # In shadow mode every hit is audited and nothing cached is ever served
+        self.audit_rate = 1.0 if shadow else audit_rate
+        self.audit_min_similarity = audit_min_similarity
+        self.reuse_results = reuse_results and not shadow
+        self.results_ttl = results_ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # entry_id -> entry, least recently used first
+        self._index = MultiIndexHashTable(max_distance)
+        self._next_id = 0
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "result_reuses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "hash_errors": 0,
+            "audits": 0,
+            "false_hits": 0,
+        }
+
+    def hash_image(self, image_data):
+        try:
+            return dhash(image_data)
+        except Exception as e:
+            with self._lock:
+                self._stats["hash_errors"] += 1
+            logger.warning(f"Perceptual hash failed: {str(e)}")
+            return None
+
+    def lookup(self, image_hash):
+        """Return the closest stored entry within max_distance, or None"""
+        with self._lock:
+            self._stats["lookups"] += 1
+            best = None
+            best_distance = self.max_distance + 1
+            for entry_id in self._index.candidates(image_hash):
+                entry = self._entries[entry_id]
+                distance = hamming_distance(image_hash, entry["hash"])
+                if distance < best_distance:
+                    best, best_distance = entry, distance
+
+            if best is None:
+                self._stats["misses"] += 1
+                return None
+
+            self._stats["hits"] += 1
+            self._entries.move_to_end(best["id"])
+            best["hits"] += 1
+            best["last_distance"] = best_distance
+            return best
+
+    def store(self, image_hash, embeddings):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            entry = {
+                "id": entry_id,
+                "hash": image_hash,
+                "embeddings": embeddings,
+                "results": {},
+                "hits": 0,
+                "last_distance": None,
+            }
+            self._entries[entry_id] = entry
+            self._index.add(image_hash, entry_id)
+            self._stats["stores"] += 1
+
+            while len(self._entries) > self.capacity:
+                _, evicted = self._entries.popitem(last=False)
+                self._index.remove(evicted["hash"], evicted["id"])
+                self._stats["evictions"] += 1
+
+        return entry
+
+    def get_results(self, entry, index_name, top_k):
+        if not self.reuse_results:
+            return None
+        with self._lock:
+            cached = entry["results"].get((index_name, top_k))
+            if cached is None or time.time() - cached[1] > self.results_ttl:
+                return None
+            self._stats["result_reuses"] += 1
+            return cached[0]
+
+    def store_results(self, entry, index_name, top_k, results):
+        if not self.reuse_results:
+            return
+        with self._lock:
+            entry["results"][(index_name, top_k)] = (results, time.time())
+
+    def should_audit(self):
+        return self.audit_rate > 0 and random.random() < self.audit_rate
+
+    def audit(self, entry, fresh_embeddings):
+        """Compare a hit's stored embedding with a freshly generated one.
+
+        A similarity below audit_min_similarity counts as a false hit and the entry
+        is refreshed with the new embedding. Returns True when the hit was good.
+        """
+        similarity = cosine_similarity(entry["embeddings"], fresh_embeddings)
+        good = similarity >= self.audit_min_similarity
+        with self._lock:
+            self._stats["audits"] += 1
+            if not good:
+                self._stats["false_hits"] += 1
+                entry["embeddings"] = fresh_embeddings
+                entry["results"] = {}
+        if not good:
+            logger.warning(f"Perceptual hash false hit: distance {entry['last_distance']}, similarity {similarity:.4f}")
+        return good
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["mode"] = "shadow" if self.shadow else "reuse"
+        stats["max_distance"] = self.max_distance
+        stats["capacity"] = self.capacity
+        stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        stats["false_hit_rate"] = round(stats["false_hits"] / stats["audits"], 4) if stats["audits"] else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_mode():
+    """PHASH_MODE (off, shadow, reuse); PHASH_ENABLED=1 without a mode means reuse"""
+    mode = os.getenv("PHASH_MODE", "").strip().lower()
+    if not mode:
+        mode = "reuse" if os.getenv("PHASH_ENABLED", "0").strip().lower() in ("1", "true", "yes", "on") else "off"
+    return mode if mode in ("off", "shadow", "reuse") else "off"
+
+
+def get_phash_cache():
+    """Process-wide cache configured from the environment, None when off or Pillow is missing"""
+    global _cache
+    mode = get_mode()
+    if Image is None or mode == "off":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = PerceptualHashCache(
+                    max_distance=int(os.getenv("PHASH_MAX_DISTANCE", "4")),
+                    capacity=int(os.getenv("PHASH_CAPACITY", "5000")),
+                    audit_rate=float(os.getenv("PHASH_AUDIT_RATE", "0.05")),
+                    audit_min_similarity=float(os.getenv("PHASH_AUDIT_MIN_SIMILARITY", "0.95")),
+                    reuse_results=os.getenv("PHASH_REUSE_RESULTS", "0").strip().lower() in ("1", "true", "yes", "on"),
+                    results_ttl=float(os.getenv("PHASH_RESULTS_TTL", "300")),
+                    shadow=mode == "shadow",
+                )
+    return _cache
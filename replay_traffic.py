@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Replay captured search traffic (see traffic_capture.py) against a running instance.
+
+Requests are re-sent with their original endpoint, index, topK, number of files,
+fields/format/fusion, Accept and Accept-Encoding headers and deadline budget,
+keeping the original inter-arrival times divided by --speed. Image content comes
+from sampled payloads (--payload-dir, matched by SHA-256) or, failing that, from the
+image in --images-dir closest in size to the original upload.
+
+    python replay_traffic.py capture.jsonl --target http://localhost:8000 \\
+        --images-dir ./sample-images --speed 4 --summary build-b.json --compare build-a.json
+
+The summary holds latency percentiles of the replay, overall and per endpoint, next to
+the latencies recorded at capture time, so two builds can be compared on the same workload.
+Captured requests without files have nothing to replay; they are counted as "skipped".
+"""
+
+import argparse
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def load_records(paths, limit=None):
+    records = []
+    for path in paths:
+        with open(path) as capture_file:
+            for line in capture_file:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit else records
+
+
+class PayloadSource:
+    """Finds image bytes for a captured file entry"""
+
+    def __init__(self, payload_dir=None, images_dir=None):
+        self.payload_dir = payload_dir
+        self.images = []  # (size, path), sorted by size
+        if images_dir:
+            for root, _, files in os.walk(images_dir):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    self.images.append((os.path.getsize(path), path))
+            self.images.sort()
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _read(self, path):
+        with self._lock:
+            data = self._cache.get(path)
+        if data is None:
+            with open(path, "rb") as image_file:
+                data = image_file.read()
+            with self._lock:
+                self._cache[path] = data
+        return data
+
+    def get(self, entry):
+        if self.payload_dir and entry.get("sha256"):
+            path = os.path.join(self.payload_dir, entry["sha256"] + ".bin")
+            if os.path.exists(path):
+                return self._read(path)
+        if self.images:
+            size = entry.get("bytes") or 0
+            position = bisect.bisect_left(self.images, (size, ""))
+            candidates = self.images[max(0, position - 1):position + 1]
+            _, path = min(candidates, key=lambda image: abs(image[0] - size))
+            return self._read(path)
+        return None
+
+
+def send(session, target, record, payloads, timeout):
+    endpoint = record["endpoint"]
+    images = [payloads.get(entry) for entry in record["files"]]
+    if any(image is None for image in images):
+        return None, "no payload"
+
+    url = target.rstrip("/") + endpoint
+    # Replay the response shape and deadline of the original request, they change server cost.
+    # A None header value makes requests leave the header out, like the original client did.
+    params = {"indexName": record.get("indexName"), "topK": record.get("topK")}
+    if record.get("fields"):
+        params["fields"] = ",".join(record["fields"])
+    if record.get("format"):
+        params["format"] = record["format"]
+    if record.get("fusion"):
+        params["fusion"] = record["fusion"]  # one fused search for all files, only /search accepts it
+    headers = {}
+    if "acceptEncoding" in record:  # captures from older builds lack the headers, keep requests' defaults
+        headers = {"Accept-Encoding": record["acceptEncoding"], "Accept": record.get("accept")}
+    if record.get("timeout") is not None:
+        headers["X-Request-Timeout"] = str(record["timeout"])
+
+    start_time = time.time()
+    try:
+        if endpoint == "/search/raw":
+            response = session.post(url, params=params, data=images[0], headers=headers, timeout=timeout)
+        elif endpoint == "/search/batch":
+            if msgpack is None:
+                return None, "msgpack not installed"
+            body = {
+                "indexName": params["indexName"],
+                "topK": params["topK"],
+                "images": [{"name": f"replay-{i}.jpg", "data": image} for i, image in enumerate(images)],
+            }
+            if record.get("fields"):
+                body["fields"] = record["fields"]
+            if record.get("format"):
+                body["format"] = record["format"]
+            headers["Content-Type"] = "application/msgpack"
+            response = session.post(url, data=msgpack.packb(body, use_bin_type=True), headers=headers,
+                                    timeout=timeout)
+        else:
+            files = [("files", (f"replay-{i}.jpg", image)) for i, image in enumerate(images)]
+            response = session.post(url, data=params, files=files, headers=headers, timeout=timeout)
+        latency = time.time() - start_time
+        return latency, None if response.status_code < 400 else f"HTTP {response.status_code}"
+    except requests.RequestException as e:
+        return time.time() - start_time, type(e).__name__
+
+
+def percentiles(latencies_ms):
+    if not latencies_ms:
+        return {}
+    ordered = sorted(latencies_ms)
+    summary = {f"p{pct}": round(ordered[min(len(ordered) - 1, int(pct / 100.0 * len(ordered)))], 1)
+               for pct in PERCENTILES}
+    summary["mean"] = round(sum(ordered) / len(ordered), 1)
+    summary["max"] = round(ordered[-1], 1)
+    summary["count"] = len(ordered)
+    return summary
+
+
+def replay(args):
+    records = load_records(args.captures, args.limit)
+    if not records:
+        print("No captured requests found", file=sys.stderr)
+        return {}
+
+    payloads = PayloadSource(args.payload_dir, args.images_dir)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    results = []  # (endpoint, latency, error, recorded_ms)
+    results_lock = threading.Lock()
+
+    def run(record):
+        latency, error = send(session, args.target, record, payloads, args.timeout)
+        with results_lock:
+            results.append((record["endpoint"], latency, error, record.get("duration_ms")))
+
+    # Requests that failed before any file was captured have nothing to replay
+    skipped = [record for record in records if not record.get("files")]
+    records = [record for record in records if record.get("files")]
+
+    start_time = time.time()
+    futures = {}
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for record in records:
+            # Keep the captured arrival pattern, compressed by --speed
+            delay = (record["ts"] - records[0]["ts"]) / args.speed - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+            futures[executor.submit(run, record)] = record
+
+    # A crash in run() must not make a request disappear from the summary
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Replaying a {futures[future]['endpoint']} request failed: {e!r}", file=sys.stderr)
+            results.append((futures[future]["endpoint"], None, type(e).__name__, None))
+
+    summary = {"target": args.target, "speed": args.speed, "requests": len(results),
+               "skipped": len(skipped), "wall_seconds": round(time.time() - start_time, 1), "endpoints": {}}
+    errors = {}
+    for endpoint, latency, error, _ in results:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+    summary["errors"] = errors
+
+    def describe(rows):
+        return {
+            "replay_ms": percentiles([latency * 1000 for _, latency, error, _ in rows if latency and not error]),
+            "recorded_ms": percentiles([recorded for _, _, _, recorded in rows if recorded is not None]),
+        }
+
+    summary["overall"] = describe(results)
+    for endpoint in sorted({row[0] for row in results}):
+        summary["endpoints"][endpoint] = describe([row for row in results if row[0] == endpoint])
+    return summary
+
+
+def compare(baseline, current):
+    """Print p50..p99 of the overall replay latency of two summaries side by side"""
+    base = baseline.get("overall", {}).get("replay_ms", {})
+    new = current.get("overall", {}).get("replay_ms", {})
+    print(f"{'':6} {'baseline':>10} {'current':>10} {'change':>8}")
+    for key in [f"p{pct}" for pct in PERCENTILES] + ["mean", "max"]:
+        if key in base and key in new:
+            change = (new[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+            print(f"{key:6} {base[key]:>10.1f} {new[key]:>10.1f} {change:>+7.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", help="capture files written with TRAFFIC_CAPTURE_PATH")
+    parser.add_argument("--target", default="http://localhost:8000", help="base URL of the instance under test")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 2 = twice as fast")
+    parser.add_argument("--payload-dir", help="TRAFFIC_CAPTURE_DIR with sampled <sha256>.bin payloads")
+    parser.add_argument("--images-dir", help="images used in place of payloads that were not sampled")
+    parser.add_argument("--concurrency", type=int, default=32, help="maximum requests in flight")
+    parser.add_argument("--timeout", type=float, default=120, help="per-request timeout in seconds")
+    parser.add_argument("--limit", type=int, help="replay only the first N captured requests")
+    parser.add_argument("--summary", help="write the latency summary to this JSON file")
+    parser.add_argument("--compare", help="summary JSON of a previous replay to compare against")
+    args = parser.parse_args(argv)
+
+    if not args.payload_dir and not args.images_dir:
+        parser.error("one of --payload-dir or --images-dir is required")
+
+    summary = replay(args)
+    print(json.dumps(summary, indent=2))
+    if args.summary:
+        with open(args.summary, "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(json.load(baseline_file), summary)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Opt-in per-request CPU sampling profiler.
+
+A request is profiled when it carries an X-Profile header matching ADMIN_TOKEN, or
+when it is picked by PROFILE_SAMPLE_RATE (0 by default). A background thread then
+samples the stacks of the request thread (and of any worker thread started through
+wrap()) every PROFILE_INTERVAL_MS and aggregates them into the folded-stack format
+read by flamegraph.pl, speedscope and similar tools.
+
+When no request is being profiled the only cost is the header/rate check.
+"""
+
+import collections
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+
+from werkzeug.utils import secure_filename
+
+INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000.0
+KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+
+# thread ident -> profiler currently sampling it
+_active = {}
+
+
+def check_admin_token(token):
+    # Read at call time so .env files loaded after import are honoured
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or token is None:
+        return False
+    # compare_digest only accepts ASCII str; headers are decoded as latin-1, so compare bytes
+    return hmac.compare_digest(token.encode("utf-8"), admin_token.encode("utf-8"))
+
+
+def should_profile(profile_header):
+    if profile_header is not None and check_admin_token(profile_header):
+        return True
+    sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, profile_id, interval=INTERVAL, client_request_id=None):
+        # profile_id is generated by the server and keys the store; the caller's
+        # X-Request-ID is only kept for reference so it can never overwrite another profile
+        self.profile_id = profile_id
+        self.client_request_id = client_request_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.sample_count = 0
+        self.started_at = None
+        self.duration = None
+        self._threads = set()
+        self._threads_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name=f"profiler-{profile_id}", daemon=True)
+
+    def add_thread(self, ident):
+        with self._threads_lock:
+            self._threads.add(ident)
+        _active[ident] = self
+
+    def remove_thread(self, ident):
+        with self._threads_lock:
+            self._threads.discard(ident)
+        if _active.get(ident) is self:
+            del _active[ident]
+
+    def start(self):
+        self.started_at = time.time()
+        self.add_thread(threading.get_ident())
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.remove_thread(threading.get_ident())
+        self.duration = time.time() - self.started_at
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._threads_lock:
+                idents = list(self._threads)
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+                self.sample_count += 1
+
+    def folded(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+
+def wrap(func):
+    """Make func, when run on another thread, part of the calling request's profile"""
+    profiler = _active.get(threading.get_ident())
+    if profiler is None:
+        return func
+
+    def profiled(*args, **kwargs):
+        ident = threading.get_ident()
+        profiler.add_thread(ident)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.remove_thread(ident)
+    return profiled
+
+
+class ProfileStore:
+    """Keeps the most recent profiles in memory, and on disk when PROFILE_DIR is set"""
+
+    def __init__(self, keep=KEEP, profile_dir=PROFILE_DIR):
+        self.profile_dir = profile_dir
+        self._profiles = collections.OrderedDict()
+        self._keep = keep
+        self._lock = threading.Lock()
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def add(self, profiler, method, path, status):
+        profile = {
+            "id": profiler.profile_id,
+            "request_id": profiler.client_request_id,
+            "method": method,
+            "path": path,
+            "status": status,
+            "started_at": profiler.started_at,
+            "duration_ms": round(profiler.duration * 1000, 1),
+            "samples": profiler.sample_count,
+            "folded": profiler.folded(),
+        }
+        with self._lock:
+            self._profiles[profile["id"]] = profile
+            while len(self._profiles) > self._keep:
+                self._profiles.popitem(last=False)
+
+        if self.profile_dir:
+            filename = secure_filename(f"{profile['id']}.folded")
+            with open(os.path.join(self.profile_dir, filename), "w") as profile_file:
+                profile_file.write(profile["folded"])
+        return profile
+
+    def list(self):
+        with self._lock:
+            return [
+                {key: value for key, value in profile.items() if key != "folded"}
+                for profile in reversed(self._profiles.values())
+            ]
+
+    def get(self, profile_id):
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+
+store = ProfileStore()
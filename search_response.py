@@ -0,0 +1,192 @@
+import gzip
+import json
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Fall back to the standard library encoder
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Brotli is optional, gzip is always available
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # /search/batch answers 415 without it
+
+
+ORIGINAL_FILE_BASE_URL = 'https://filestoragepath.blob.core.windows.net/file-test-storage/'
+
+# Fields that are the same for every hit of one file, hoisted out in the compact shape
+PER_FILE_FIELDS = ("modelName", "originalFile")
+
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+# Responses smaller than this are sent uncompressed
+MIN_COMPRESS_BYTES = 1024
+
+
+def format_search_results(indexName, filename, results):
+    """Format raw ImageSearchAPI results for one file according to the index naming scheme"""
+    formatted_results = []
+    for result in results:
+        if indexName == "product-pro-type-code-part" or indexName == "product-pro-type-code-used" or \
+                indexName == "product-pro-type-code-packaging":
+            product_type = str(result['title']).split("-")[0]
+            product_code = str(result['title']).split("-")[1]
+            formatted_result = {
+                "modelName": indexName,
+                "originalFile": filename,
+                "productType": product_type,
+                "productCode": product_code,
+                "similarFile": result['imageUrl'],
+                "confidence_score": result.get('confidence_score', 0),
+                "similarity_percentage": result.get('similarity_percentage', 0)
+            }
+            formatted_results.append(formatted_result)
+        elif indexName == "product-carmodelclean":
+            # Change the pattern for other_index
+            model_cars = str(result['title']).split("-")[0]
+            formatted_result = {
+                "modelName": indexName,
+                "originalFile": filename,
+                "modelCars": model_cars,
+                "similarFile": result['imageUrl'],
+                "similarity_percentage": result.get('similarity_percentage', 0)
+            }
+            formatted_results.append(formatted_result)
+        elif indexName == "product-carmodel-type-code-used":
+            # Change the pattern for other_index with error handling
+            title_parts = str(result['title']).split(".")
+
+            # Ensure we have at least 3 parts, otherwise use defaults
+            model_cars = title_parts[0] if len(title_parts) > 0 else "Unknown"
+            product_type = title_parts[1] if len(title_parts) > 1 else "Unknown"
+            product_code = title_parts[2] if len(title_parts) > 2 else "Unknown"
+
+            formatted_result = {
+                "modelName": indexName,
+                "originalFile": filename,
+                "modelCars": model_cars,
+                "productType": product_type,
+                "productCode": product_code,
+                "similarFile": result['imageUrl'],
+                "similarity_percentage": result.get('similarity_percentage', 0),
+                "title_format": f"Parts found: {len(title_parts)} (expected: 3)"
+            }
+            formatted_results.append(formatted_result)
+    return formatted_results
+
+
+def parse_fields(fields_param):
+    """Parse a comma separated fields= parameter, None means all fields"""
+    if not fields_param:
+        return None
+    fields = [field.strip() for field in fields_param.split(",") if field.strip()]
+    return fields or None
+
+
+def project_fields(formatted_results, fields):
+    """Keep only the requested fields of every hit, error entries are left untouched"""
+    if not fields or not isinstance(formatted_results, list):
+        return formatted_results
+    return [{key: hit[key] for key in fields if key in hit} for hit in formatted_results]
+
+
+def to_compact(formatted_results):
+    """Convert one file's hit list into a columnar shape.
+
+    Per-file values (modelName, originalFile) are sent once, every hit becomes a row
+    of values in the order of "fields". similarity_percentage is dropped when
+    confidence_score is present since it is just confidence_score * 100.
+    """
+    if not isinstance(formatted_results, list):
+        return formatted_results  # error entry
+
+    compact = {"fields": [], "rows": []}
+    if not formatted_results:
+        return compact
+
+    first = formatted_results[0]
+    for key in PER_FILE_FIELDS:
+        if key in first:
+            compact[key] = first[key]
+
+    columns = [key for key in first if key not in PER_FILE_FIELDS]
+    if "confidence_score" in columns and "similarity_percentage" in columns:
+        columns.remove("similarity_percentage")
+
+    compact["fields"] = columns
+    compact["rows"] = [[hit.get(key) for key in columns] for hit in formatted_results]
+    return compact
+
+
+def dumps(payload):
+    """Serialize payload to compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _accepted_encodings(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, params = part.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    return accepted
+
+
+def choose_encoding(accept_encoding):
+    """Pick br or gzip from an Accept-Encoding header, None for identity"""
+    accepted = _accepted_encodings(accept_encoding)
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def json_response(payload, accept_encoding=None, status=200):
+    """Build a JSON response using the fast encoder, compressed when the client accepts it"""
+    body = dumps(payload)
+    response = Response(status=status, mimetype="application/json")
+    response.headers["Vary"] = "Accept-Encoding"
+
+    encoding = choose_encoding(accept_encoding) if len(body) >= MIN_COMPRESS_BYTES else None
+    if encoding:
+        body = compress(body, encoding)
+        response.headers["Content-Encoding"] = encoding
+
+    response.set_data(body)
+    return response
+
+
+def accepts_msgpack(accept):
+    return msgpack is not None and any(mimetype in (accept or "") for mimetype in MSGPACK_MIMETYPES)
+
+
+def msgpack_response(payload, status=200):
+    """MessagePack response, already compact so it is not compressed again"""
+    return Response(msgpack.packb(payload, use_bin_type=True), status=status, mimetype="application/msgpack")
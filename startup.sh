@@ -73,15 +73,19 @@ except Exception as e:
 echo "🚀 Starting Gunicorn with full logging..."
 
 # Start Gunicorn with comprehensive logging
+# gunicorn_hooks.py only adds the post-fork warm-up hooks, all server settings are the flags below
+# GUNICORN_MAX_REQUESTS=0 disables worker recycling, check /stats/memory before turning it off
 exec gunicorn \
+    --config=gunicorn_hooks.py \
     --bind=0.0.0.0:${PORT:-8000} \
     --workers=1 \
     --worker-class=sync \
+    --threads=1 \
     --timeout=600 \
     --graceful-timeout=60 \
     --keep-alive=5 \
-    --max-requests=500 \
-    --max-requests-jitter=50 \
+    --max-requests=${GUNICORN_MAX_REQUESTS:-500} \
+    --max-requests-jitter=${GUNICORN_MAX_REQUESTS_JITTER:-50} \
     --preload \
     --access-logfile='-' \
     --error-logfile='-' \
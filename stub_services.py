@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the Azure AI Vision and Azure AI Search endpoints with injected latency.
+
+Used to exercise multi-endpoint routing and hedging (hedging.py) without Azure, e.g.
+two replicas where one is occasionally slow:
+
+    python stub_services.py --port 9001 --latency-ms 40 &
+    python stub_services.py --port 9002 --latency-ms 40 --slow-rate 0.1 --slow-ms 1500 &
+    export AZURE_AI_VISION_ENDPOINTS=http://127.0.0.1:9001,http://127.0.0.1:9002
+    export AZURE_SEARCH_SERVICE_ENDPOINTS=http://127.0.0.1:9001,http://127.0.0.1:9002
+
+then watch /stats/hedging. Blob Storage is not stubbed here, use Azurite for it.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEARCH_PATH = re.compile(r"^/indexes(?:\('([^']+)'\)|/([^/]+))/docs/search\.post\.search")
+COUNT_PATH = re.compile(r"^/indexes(?:\('([^']+)'\)|/([^/]+))/docs/\$count")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = None  # argparse namespace, set in main()
+
+    def _delay(self):
+        settings = self.settings
+        latency = settings.latency_ms + random.uniform(0, settings.jitter_ms)
+        if random.random() < settings.slow_rate:
+            latency += settings.slow_ms
+        time.sleep(latency / 1000.0)
+        return random.random() < settings.error_rate
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def log_message(self, format, *args):
+        if not self.settings.quiet:
+            super().log_message(format, *args)
+
+    def do_HEAD(self):
+        self._send(200, b"")
+
+    def do_GET(self):
+        if COUNT_PATH.match(self.path):
+            if self._delay():
+                return self._send(503, {"error": "injected failure"})
+            return self._send(200, b"1000", "text/plain")
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self._read_json()
+        if self._delay():
+            return self._send(503, {"error": "injected failure"})
+
+        if self.path.startswith("/computervision/retrieval:vectorizeImage"):
+            # Deterministic vector per image URL so repeated calls agree
+            seed = int(hashlib.sha256(str(body.get("url")).encode("utf-8")).hexdigest()[:16], 16)
+            rng = random.Random(seed)
+            vector = [rng.uniform(-1, 1) for _ in range(self.settings.dimensions)]
+            return self._send(200, {"modelVersion": "2023-04-15", "vector": vector})
+
+        match = SEARCH_PATH.match(self.path)
+        if match:
+            queries = body.get("vectorQueries") or [{}]
+            k = max(query.get("k") or 5 for query in queries)
+            value = [
+                {
+                    "@search.score": round(0.95 - i * 0.01, 4),
+                    "title": f"TYPE{i}-CODE{i}",
+                    "imageUrl": f"http://{self.headers.get('Host')}/images/{i}.jpg",
+                }
+                for i in range(k)
+            ]
+            return self._send(200, {"value": value})
+
+        self._send(404, {"error": "not found"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--latency-ms", type=float, default=50, help="base latency of every call")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="uniform random extra latency")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of calls that are slow")
+    parser.add_argument("--slow-ms", type=float, default=2000, help="extra latency of slow calls")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 503")
+    parser.add_argument("--dimensions", type=int, default=1024, help="length of returned vectors")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args()
+
+    StubHandler.settings = args
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"Stub Vision/Search listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Opt-in capture of production search traffic shapes for replay_traffic.py.
+
+Enabled by TRAFFIC_CAPTURE_PATH. A share of search requests (TRAFFIC_CAPTURE_RATE)
+is written as one JSON line each: endpoint, index, topK, the parameters that change
+server cost (fields, format, fusion, Accept / Accept-Encoding, deadline budget),
+status, total duration and, per file, its size, per-stage timings and, depending on
+TRAFFIC_CAPTURE_PAYLOADS:
+
+    none    nothing about the content
+    hash    the SHA-256 of the image (default)
+    sample  the hash, and a TRAFFIC_CAPTURE_SAMPLE_RATE share of images saved to
+            TRAFFIC_CAPTURE_DIR as <sha256>.bin so replays can send real images
+
+Nothing is captured and no per-request work is done when TRAFFIC_CAPTURE_PATH is unset.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+CAPTURED_ENDPOINTS = ("/search", "/search/raw", "/search/batch")
+
+_write_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def _env(name, default=None):
+    value = os.getenv(name)
+    return value if value not in (None, "") else default
+
+
+def should_capture(path):
+    if not _env("TRAFFIC_CAPTURE_PATH") or path not in CAPTURED_ENDPOINTS:
+        return False
+    rate = float(_env("TRAFFIC_CAPTURE_RATE", "1"))
+    return rate >= 1 or random.random() < rate
+
+
+def _hash_stream(stream):
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class TrafficCapture:
+    def __init__(self, endpoint, accept=None, accept_encoding=None):
+        self.started_at = time.time()
+        self.record = {
+            "ts": round(self.started_at, 3),
+            "endpoint": endpoint,
+            "indexName": None,
+            "topK": None,
+            "fields": None,
+            "format": None,
+            "accept": accept,
+            "acceptEncoding": accept_encoding,
+            "timeout": None,
+            "fusion": None,
+            "files": [],
+        }
+        self.payload_mode = _env("TRAFFIC_CAPTURE_PAYLOADS", "hash")
+
+    def set_shape(self, fields=None, compact=False, deadline=None, fusion=None):
+        """Record the parameters that change server cost besides the images themselves"""
+        self.record["fields"] = fields
+        self.record["format"] = "compact" if compact else None
+        # The budget the request started with, replayed as X-Request-Timeout
+        self.record["timeout"] = round(deadline.budget, 3) if deadline is not None else None
+        # A fused /search is one search round trip for all files, not one per file
+        self.record["fusion"] = fusion
+
+    def add_file(self, file, index_name, top_k, timings, ok, read_payload=True):
+        """Record one searched file; never raises, capture must not break a request"""
+        try:
+            self._add_file(file, index_name, top_k, timings, ok, read_payload)
+        except Exception as e:
+            logger.warning(f"Traffic capture failed for {file.filename}: {str(e)}")
+
+    def _add_file(self, file, index_name, top_k, timings, ok, read_payload):
+        self.record["indexName"] = index_name
+        self.record["topK"] = top_k
+        entry = {"bytes": None, "ok": ok, "stage_ms": dict(timings or {})}
+        self.record["files"].append(entry)
+        if not read_payload:
+            return
+
+        stream = file.stream
+        stream.seek(0, os.SEEK_END)
+        entry["bytes"] = stream.tell()
+        stream.seek(0)
+
+        if self.payload_mode in ("hash", "sample"):
+            entry["sha256"] = _hash_stream(stream)
+        if self.payload_mode == "sample":
+            sample_rate = float(_env("TRAFFIC_CAPTURE_SAMPLE_RATE", "0.1"))
+            capture_dir = _env("TRAFFIC_CAPTURE_DIR")
+            if capture_dir and random.random() < sample_rate:
+                os.makedirs(capture_dir, exist_ok=True)
+                sample_path = os.path.join(capture_dir, entry["sha256"] + ".bin")
+                if not os.path.exists(sample_path):
+                    file.save(sample_path)
+                    stream.seek(0)
+                entry["sampled"] = True
+
+    def finish(self, status):
+        self.record["status"] = status
+        self.record["duration_ms"] = round((time.time() - self.started_at) * 1000, 1)
+        line = json.dumps(self.record, separators=(",", ":")) + "\n"
+        try:
+            with _write_lock:
+                with open(_env("TRAFFIC_CAPTURE_PATH"), "a") as capture_file:
+                    capture_file.write(line)
+        except OSError as e:
+            logger.warning(f"Traffic capture write failed: {str(e)}")
@@ -0,0 +1,184 @@
+"""
+Per-worker warm-up of Azure clients and connections.
+
+Gunicorn calls warm_up() from post_worker_init (see gunicorn_hooks.py), after the
+worker has been forked and before it starts accepting requests, so the first
+/search in a fresh or recycled worker does not pay for DNS, TLS and SDK setup.
+Servers without that hook (wsgi.py, startup.py, app.run) warm up in the background
+on the first /ready probe instead, see start_in_background().
+"""
+
+import logging
+import os
+import threading
+import time
+
+from deadline import Deadline
+from ImageSearch import ImageSearchAPI, RawVectorQuery, get_search_client, get_vision_session
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WARMUP_INDEXES = (
+    "product-pro-type-code-part",
+    "product-pro-type-code-used",
+    "product-pro-type-code-packaging",
+    "product-carmodelclean",
+    "product-carmodel-type-code-used",
+)
+
+_state = {"status": "not_started", "pid": None, "total_seconds": None, "steps": []}
+_state_lock = threading.Lock()
+
+
+def _env_flag(name, default):
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+def configured_indexes():
+    """Indexes to warm up, from WARMUP_INDEXES (comma separated) or the known indexes"""
+    value = os.getenv("WARMUP_INDEXES")
+    if not value:
+        return list(DEFAULT_WARMUP_INDEXES)
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+def _run_step(steps, name, func, budget=None):
+    start_time = time.time()
+    step = {"step": name}
+    if budget is not None and budget.expired():
+        # Out of warm-up budget: record the step so /ready shows what was not warmed
+        step.update(ok=False, skipped=True, seconds=0.0)
+        steps.append(step)
+        return False
+    try:
+        func()
+        step["ok"] = True
+    except Exception as e:
+        step["ok"] = False
+        step["error"] = str(e)
+        logger.warning(f"Warm-up step {name} failed: {str(e)}")
+    step["seconds"] = round(time.time() - start_time, 3)
+    steps.append(step)
+    return step["ok"]
+
+
+def warm_up(index_names=None, probe=None):
+    """Build clients for the configured indexes and open a pooled connection to each dependency.
+
+    With probe=True (or WARMUP_PROBE=1) a cheap top-1 vector query is also run
+    against every index. Failures are recorded but never stop the worker from starting.
+
+    The worker sends no heartbeats while this runs, so every call is bounded by
+    WARMUP_STEP_TIMEOUT (no SDK retries) and the whole warm-up by WARMUP_BUDGET_SECONDS,
+    which must stay well below the gunicorn worker timeout; steps left when the budget
+    is spent are skipped.
+    """
+    if not _env_flag("WARMUP_ENABLED", "1"):
+        with _state_lock:
+            _state.update(status="disabled", pid=os.getpid())
+        return get_status()
+
+    if index_names is None:
+        index_names = configured_indexes()
+    if probe is None:
+        probe = _env_flag("WARMUP_PROBE", "0")
+
+    with _state_lock:
+        _state.update(status="running", pid=os.getpid(), total_seconds=None, steps=[])
+
+    start_time = time.time()
+    budget = Deadline(float(os.getenv("WARMUP_BUDGET_SECONDS", "60")))
+    step_timeout = float(os.getenv("WARMUP_STEP_TIMEOUT", "5"))
+
+    def sdk_timeouts():
+        # azure-core defaults are 300 s connect/read plus retries, far too long for warm-up
+        timeout = max(0.1, budget.timeout(step_timeout))
+        return {"connection_timeout": timeout, "read_timeout": timeout, "retry_total": 0}
+
+    steps = []
+    all_ok = True
+    apis = []
+
+    for index_name in index_names:
+        def build(index_name=index_name):
+            apis.append(ImageSearchAPI(indexName=index_name, topK=1))
+        all_ok &= _run_step(steps, f"init:{index_name}", build, budget)
+
+    if apis:
+        # Every index and search replica has its own SearchClient pipeline, so each one gets its own connection
+        for api in apis:
+            for target in api.search_endpoints:
+                search_client = get_search_client(target["url"], api.indexName, target["key"])
+                all_ok &= _run_step(
+                    steps, f"search:{target['url']}:{api.indexName}",
+                    lambda search_client=search_client: search_client.get_document_count(**sdk_timeouts()),
+                    budget
+                )
+
+        all_ok &= _run_step(
+            steps, "blob", lambda: apis[0].container_client.get_container_properties(**sdk_timeouts()), budget
+        )
+
+        for target in apis[0].vision_endpoints:
+            # Any HTTP answer is fine here, the point is the DNS lookup and TLS handshake
+            vision_endpoint = target["url"].rstrip('/')
+            all_ok &= _run_step(
+                steps, f"vision:{vision_endpoint}",
+                lambda vision_endpoint=vision_endpoint: get_vision_session().head(
+                    vision_endpoint, timeout=max(0.1, budget.timeout(step_timeout))
+                ),
+                budget
+            )
+
+        if probe:
+            dimensions = int(os.getenv("WARMUP_PROBE_DIMENSIONS", "1024"))
+            probe_vector = [1.0] + [0.0] * (dimensions - 1)
+            for api in apis:
+                for target in api.search_endpoints:
+                    def run_probe(api=api, target=target):
+                        # search_with_embeddings logs and swallows errors, use each replica's client directly
+                        search_client = get_search_client(target["url"], api.indexName, target["key"])
+                        vector_query = RawVectorQuery(vector=probe_vector, k=1, fields="imageVector")
+                        list(search_client.search(
+                            search_text=None, vector_queries=[vector_query], select=["title"], **sdk_timeouts()
+                        ))
+                    all_ok &= _run_step(steps, f"probe:{target['url']}:{api.indexName}", run_probe, budget)
+
+    total_time = time.time() - start_time
+    status = "ready" if all_ok else "degraded"
+    with _state_lock:
+        _state.update(
+            status=status,
+            total_seconds=round(total_time, 3),
+            steps=steps,
+        )
+    logger.info(f"Worker {os.getpid()} warm-up finished in {total_time:.2f} seconds ({status})")
+    return get_status()
+
+
+def start_in_background():
+    """Start warm_up() in a thread unless it already ran or is running in this process.
+
+    Under gunicorn the post_worker_init hook finishes before any request is served,
+    so this only kicks in when the app runs without that hook.
+    """
+    with _state_lock:
+        if _state["status"] != "not_started" and _state["pid"] == os.getpid():
+            return False
+        _state.update(status="running", pid=os.getpid(), total_seconds=None, steps=[])
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    return True
+
+
+def get_status():
+    with _state_lock:
+        return {
+            "status": _state["status"],
+            "pid": _state["pid"],
+            "total_seconds": _state["total_seconds"],
+            "steps": list(_state["steps"]),
+        }
+
+
+def is_ready():
+    return get_status()["status"] in ("ready", "degraded", "disabled")